@@ -307,6 +307,10 @@ class GajimApplication(Gtk.Application):
         if hasattr(self.interface, 'roster') and self.interface.roster:
             self.interface.roster.prepare_quit()
 
+        if app.is_installed('FARSTREAM'):
+            from gajim.common.multimedia_helpers import DeviceManager
+            DeviceManager.stop_monitor()
+
         # Commit any outstanding SQL transactions
         app.logger.commit()
 
@@ -1439,13 +1439,14 @@ def delay_execution(milliseconds):
         @wraps(func)
         def func_wrapper(*args, **kwargs):
             def timeout_wrapper():
+                func_wrapper.source_id = None
                 func(*args, **kwargs)
-                delattr(func_wrapper, 'source_id')
 
-            if hasattr(func_wrapper, 'source_id'):
+            if func_wrapper.source_id is not None:
                 return
             func_wrapper.source_id = GLib.timeout_add(
                 milliseconds, timeout_wrapper)
+        func_wrapper.source_id = None
         return func_wrapper
     return delay_execution_decorator
 
@@ -19,10 +19,11 @@
 # along with Gajim. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
 import sys
 import locale
 import gettext
-import unicodedata
+import functools
 from pathlib import Path
 
 DOMAIN = 'gajim'
@@ -30,7 +31,15 @@ LANG = 'en'
 direction_mark = '\u200E'
 _translation = gettext.NullTranslations()
 
+_RTL_BIDI_CLASSES = frozenset(('AL', 'R'))
+# Matches the next character which is not an ASCII digit, whitespace,
+# punctuation or control character, these are never strong
+_STRONG_CANDIDATE_RE = re.compile(r'[^\x00-\x40\x5B-\x60\x7B-\x7F]')
+# Bound on the first call of paragraph_direction_mark()
+_bidirectional = None
 
+
+@functools.lru_cache(maxsize=None)
 def get_locale_dirs():
     if os.name == 'nt':
         return
@@ -58,18 +67,19 @@ def iter_locale_dirs():
         return
 
     # gettext fallback
-    locale_dirs.append(Path(sys.base_prefix) / 'share')
+    locale_dirs = locale_dirs + [Path(sys.base_prefix) / 'share']
 
-    found_paths = []
+    found_paths = set()
     for path in locale_dirs:
         locale_dir = path / 'locale'
         if locale_dir in found_paths:
             continue
-        found_paths.append(locale_dir)
+        found_paths.add(locale_dir)
         if locale_dir.is_dir():
             yield str(locale_dir)
 
 
+@functools.lru_cache(maxsize=1)
 def get_default_lang():
     if os.name == "nt":
         import ctypes
@@ -98,6 +108,10 @@ def get_short_lang_code(lang=None):
 
 
 def initialize_direction_mark():
+    if 'gi.repository.Gtk' not in sys.modules:
+        # Without a loaded GUI toolkit the default LTR mark is kept
+        return
+
     from gi.repository import Gtk
 
     global direction_mark
@@ -113,16 +127,29 @@ def paragraph_direction_mark(text):
 
     Returns either Unicode LTR mark or RTL mark.
     """
-    for char in text:
-        bidi = unicodedata.bidirectional(char)
+    global _bidirectional
+
+    match = _STRONG_CANDIDATE_RE.search(text)
+    while match is not None:
+        char = match.group()
+        if char <= 'z':
+            # ASCII letter
+            return '\u200E'
+        if _bidirectional is None:
+            import unicodedata
+            _bidirectional = functools.lru_cache(maxsize=4096)(
+                unicodedata.bidirectional)
+        bidi = _bidirectional(char)
         if bidi == 'L':
             return '\u200E'
-        if bidi in ('AL', 'R'):
+        if bidi in _RTL_BIDI_CLASSES:
             return '\u200F'
+        match = _STRONG_CANDIDATE_RE.search(text, match.end())
 
     return '\u200E'
 
 
+@functools.lru_cache(maxsize=1024)
 def Q_(text):
     """
     Translate the given text, optionally qualified with a special
@@ -152,6 +179,14 @@ def ngettext(s_sing, s_plural, n, replace_sing=None, replace_plural=None):
 
     In other words this is a hack to ngettext() to support %s %d etc..
     """
+    try:
+        hash((replace_sing, replace_plural))
+    except TypeError:
+        return _ngettext(s_sing, s_plural, n, replace_sing, replace_plural)
+    return _ngettext_cached(s_sing, s_plural, n, replace_sing, replace_plural)
+
+
+def _ngettext(s_sing, s_plural, n, replace_sing, replace_plural):
     text = _translation.ngettext(s_sing, s_plural, n)
     if n == 1 and replace_sing is not None:
         text = text % replace_sing
@@ -160,6 +195,9 @@ def ngettext(s_sing, s_plural, n, replace_sing=None, replace_plural=None):
     return text
 
 
+_ngettext_cached = functools.lru_cache(maxsize=2048, typed=True)(_ngettext)
+
+
 try:
     locale.setlocale(locale.LC_ALL, '')
 except locale.Error as error:
@@ -183,6 +221,8 @@ for dir_ in iter_locale_dirs():
     try:
         _translation = gettext.translation(DOMAIN, dir_)
         _ = _translation.gettext
+        Q_.cache_clear()
+        _ngettext_cached.cache_clear()
         if hasattr(locale, 'bindtextdomain'):
             locale.bindtextdomain(DOMAIN, dir_)  # type: ignore
     except OSError:
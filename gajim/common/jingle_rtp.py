@@ -16,6 +16,10 @@
 Handles Jingle RTP sessions (XEP 0167)
 """
 
+from typing import Dict  # pylint: disable=unused-import
+from typing import Tuple  # pylint: disable=unused-import
+
+import time
 import logging
 import socket
 from collections import deque
@@ -37,6 +41,25 @@ from gajim.common.jingle_session import FailedApplication
 
 log = logging.getLogger('gajim.c.jingle_rtp')
 
+# Resolved STUN server addresses: hostname -> (resolve time, ip)
+_stun_ip_cache = {}  # type: Dict[str, Tuple[float, str]]
+STUN_IP_CACHE_TTL = 300
+
+# Pipeline descriptions GStreamer failed to parse: description -> error
+_invalid_pipelines = {}  # type: Dict[str, str]
+
+
+def resolve_stun_server(stun_server):
+    now = time.monotonic()
+    cached = _stun_ip_cache.get(stun_server)
+    if cached is not None and now - cached[0] < STUN_IP_CACHE_TTL:
+        return cached[1]
+
+    ip = socket.getaddrinfo(stun_server, 0, socket.AF_UNSPEC,
+                            socket.SOCK_STREAM)[0][4][0]
+    _stun_ip_cache[stun_server] = (now, ip)
+    return ip
+
 
 class JingleRTPContent(JingleContent):
     def __init__(self, session, media, transport=None):
@@ -45,6 +68,7 @@ class JingleRTPContent(JingleContent):
         JingleContent.__init__(self, session, transport, None)
         self.media = media
         self._dtmf_running = False
+        self._dtmf_queue = deque()
         self.farstream_media = {
             'audio': Farstream.MediaType.AUDIO,
             'video': Farstream.MediaType.VIDEO}[media]
@@ -61,6 +85,10 @@ class JingleRTPContent(JingleContent):
         self.p2psession = None
         self.p2pstream = None
 
+        # Attributes and parameters of the local codecs, reset whenever
+        # farstream reports a codec change
+        self._codecs = None
+
         self.callbacks['session-initiate'] += [self.__on_remote_codecs]
         self.callbacks['content-add'] += [self.__on_remote_codecs]
         self.callbacks['description-info'] += [self.__on_remote_codecs]
@@ -70,6 +98,9 @@ class JingleRTPContent(JingleContent):
         self.callbacks['session-terminate-sent'] += [self.__stop]
 
     def setup_stream(self, on_src_pad_added):
+        use_stun_server = app.config.get('use_stun_server')
+        stun_server = app.config.get('stun_server')
+
         # pipeline and bus
         self.pipeline = Gst.Pipeline()
         bus = self.pipeline.get_bus()
@@ -82,6 +113,7 @@ class JingleRTPContent(JingleContent):
         self.funnel = None
 
         self.p2psession = self.conference.new_session(self.farstream_media)
+        self._codecs = None
 
         participant = self.conference.new_participant()
         # FIXME: Consider a workaround, here...
@@ -89,14 +121,12 @@ class JingleRTPContent(JingleContent):
         # due to bad controlling-mode
 
         params = {'controlling-mode': self.session.weinitiate, 'debug': False}
-        if app.config.get('use_stun_server'):
-            stun_server = app.config.get('stun_server')
+        if use_stun_server:
             if not stun_server and self.session.connection._stun_servers:
                 stun_server = self.session.connection._stun_servers[0]['host']
             if stun_server:
                 try:
-                    ip = socket.getaddrinfo(stun_server, 0, socket.AF_UNSPEC,
-                                            socket.SOCK_STREAM)[0][4][0]
+                    ip = resolve_stun_server(stun_server)
                 except socket.gaierror as e:
                     log.warning('Lookup of stun ip failed: %s', str(e))
                 else:
@@ -111,20 +141,28 @@ class JingleRTPContent(JingleContent):
         return JingleContent.is_ready(self) and self.candidates_ready
 
     def make_bin_from_config(self, config_key, pipeline, text):
-        pipeline = pipeline % app.config.get(config_key)
-        try:
-            gst_bin = Gst.parse_bin_from_description(pipeline, True)
-            return gst_bin
-        except GLib.GError as e:
-            app.nec.push_incoming_event(
-                InformationEvent(
-                    None, conn=self.session.connection, level='error',
-                    pri_txt=_('%s configuration error') % text.capitalize(),
-                    sec_txt=_('Couldn’t set up %(text)s. Check your '
-                    'configuration.\n\nPipeline was:\n%(pipeline)s\n\n'
-                    'Error was:\n%(error)s') % {'text': text,
-                    'pipeline': pipeline, 'error': str(e)}))
-            raise JingleContentSetupException
+        return self.make_bin(app.config.get(config_key), pipeline, text)
+
+    def make_bin(self, device, pipeline, text):
+        pipeline = pipeline % device
+        error = _invalid_pipelines.get(pipeline)
+        if error is None:
+            try:
+                gst_bin = Gst.parse_bin_from_description(pipeline, True)
+                return gst_bin
+            except GLib.GError as e:
+                error = str(e)
+                _invalid_pipelines[pipeline] = error
+
+        app.nec.push_incoming_event(
+            InformationEvent(
+                None, conn=self.session.connection, level='error',
+                pri_txt=_('%s configuration error') % text.capitalize(),
+                sec_txt=_('Couldn’t set up %(text)s. Check your '
+                'configuration.\n\nPipeline was:\n%(pipeline)s\n\n'
+                'Error was:\n%(error)s') % {'text': text,
+                'pipeline': pipeline, 'error': error}))
+        raise JingleContentSetupException
 
     def add_remote_candidates(self, candidates):
         JingleContent.add_remote_candidates(self, candidates)
@@ -139,18 +177,18 @@ class JingleRTPContent(JingleContent):
         """
         if self._dtmf_running:
             raise Exception("There is a DTMF batch already running")
-        events = deque(events)
+        self._dtmf_queue = deque(events)
         self._dtmf_running = True
-        self._start_dtmf(events.popleft())
-        GLib.timeout_add(500, self._next_dtmf, events)
+        self._start_dtmf(self._dtmf_queue.popleft())
+        GLib.timeout_add(500, self._next_dtmf)
 
-    def _next_dtmf(self, events):
+    def _next_dtmf(self):
         self._stop_dtmf()
-        if events:
-            self._start_dtmf(events.popleft())
-            GLib.timeout_add(500, self._next_dtmf, events)
-        else:
+        if not self._dtmf_queue:
             self._dtmf_running = False
+            return GLib.SOURCE_REMOVE
+        self._start_dtmf(self._dtmf_queue.popleft())
+        return GLib.SOURCE_CONTINUE
 
     def _start_dtmf(self, event):
         if event in ('*', '#'):
@@ -182,50 +220,19 @@ class JingleRTPContent(JingleContent):
 
     def _on_gst_message(self, bus, message):
         if message.type == Gst.MessageType.ELEMENT:
-            name = message.get_structure().get_name()
+            structure = message.get_structure()
+            name = structure.get_name()
             log.debug('gst element message: %s: %s', name, message)
-            if name == 'farstream-new-active-candidate-pair':
-                pass
-            elif name == 'farstream-recv-codecs-changed':
-                pass
-            elif name == 'farstream-codecs-changed':
-                if self.sent and self.p2psession.props.codecs_without_config:
-                    self.send_description_info()
-                    if self.transport.remote_candidates:
-                        # those lines MUST be done after we get info on our
-                        # codecs
-                        self.p2pstream.add_remote_candidates(
-                            self.transport.remote_candidates)
-                        self.transport.remote_candidates = []
-                        self.p2pstream.set_property('direction',
-                                                    Farstream.StreamDirection.BOTH)
-
-            elif name == 'farstream-local-candidates-prepared':
-                self.candidates_ready = True
-                if self.is_ready():
-                    self.session.on_session_state_changed(self)
-            elif name == 'farstream-new-local-candidate':
-                candidate = self.p2pstream.parse_new_local_candidate(message)[1]
-                self.transport.candidates.append(candidate)
-                if self.sent:
-                    # FIXME: Is this case even possible?
-                    self.send_candidate(candidate)
-            elif name == 'farstream-component-state-changed':
-                state = message.get_structure().get_value('state')
-                if state == Farstream.StreamState.FAILED:
-                    reason = nbxmpp.Node('reason')
-                    reason.setTag('failed-transport')
-                    self.session.remove_content(self.creator, self.name, reason)
-            elif name == 'farstream-error':
-                log.error('Farstream error #%d!\nMessage: %s',
-                          message.get_structure().get_value('error-no'),
-                          message.get_structure().get_value('error-msg'))
+            handler = self._element_message_handlers.get(name)
+            if handler is not None:
+                handler(self, message, structure)
         elif message.type == Gst.MessageType.ERROR:
             # TODO: Fix it to fallback to videotestsrc anytime an error occur,
             # or raise an error, Jingle way
             # or maybe one-sided stream?
-            gerror_msg = message.get_structure().get_value('gerror')
-            debug_msg = message.get_structure().get_value('debug')
+            structure = message.get_structure()
+            gerror_msg = structure.get_value('gerror')
+            debug_msg = structure.get_value('debug')
             log.error(gerror_msg)
             log.error(debug_msg)
             if not self.stream_failed_once:
@@ -255,6 +262,53 @@ class JingleRTPContent(JingleContent):
             # Start playing again
             self.pipeline.set_state(Gst.State.PLAYING)
 
+    def _on_codecs_changed(self, _message, _structure):
+        self._codecs = None
+        if self.sent and self.p2psession.props.codecs_without_config:
+            self.send_description_info()
+            if self.transport.remote_candidates:
+                # those lines MUST be done after we get info on our
+                # codecs
+                self.p2pstream.add_remote_candidates(
+                    self.transport.remote_candidates)
+                self.transport.remote_candidates = []
+                self.p2pstream.set_property('direction',
+                                            Farstream.StreamDirection.BOTH)
+
+    def _on_local_candidates_prepared(self, _message, _structure):
+        self.candidates_ready = True
+        if self.is_ready():
+            self.session.on_session_state_changed(self)
+
+    def _on_new_local_candidate(self, message, _structure):
+        candidate = self.p2pstream.parse_new_local_candidate(message)[1]
+        self.transport.candidates.append(candidate)
+        if self.sent:
+            # FIXME: Is this case even possible?
+            self.send_candidate(candidate)
+
+    def _on_component_state_changed(self, _message, structure):
+        state = structure.get_value('state')
+        if state == Farstream.StreamState.FAILED:
+            reason = nbxmpp.Node('reason')
+            reason.setTag('failed-transport')
+            self.session.remove_content(self.creator, self.name, reason)
+
+    def _on_farstream_error(self, _message, structure):
+        log.error('Farstream error #%d!\nMessage: %s',
+                  structure.get_value('error-no'),
+                  structure.get_value('error-msg'))
+
+    # farstream-new-active-candidate-pair and farstream-recv-codecs-changed
+    # are ignored
+    _element_message_handlers = {
+        'farstream-codecs-changed': _on_codecs_changed,
+        'farstream-local-candidates-prepared': _on_local_candidates_prepared,
+        'farstream-new-local-candidate': _on_new_local_candidate,
+        'farstream-component-state-changed': _on_component_state_changed,
+        'farstream-error': _on_farstream_error,
+    }
+
     @staticmethod
     def get_fallback_src():
         return Gst.ElementFactory.make('fakesrc', None)
@@ -277,17 +331,19 @@ class JingleRTPContent(JingleContent):
         Get peer codecs from what we get from peer
         """
 
+        new_codec = Farstream.Codec.new
+        media = self.farstream_media
         codecs = []
         for codec in content.getTag('description').iterTags('payload-type'):
-            if not codec['id'] or not codec['name'] or not codec['clockrate']:
+            id_ = codec.getAttr('id')
+            name = codec.getAttr('name')
+            clockrate = codec.getAttr('clockrate')
+            if not id_ or not name or not clockrate:
                 # ignore invalid payload-types
                 continue
-            c = Farstream.Codec.new(int(codec['id']), codec['name'],
-                                    self.farstream_media, int(codec['clockrate']))
-            if 'channels' in codec:
-                c.channels = int(codec['channels'])
-            else:
-                c.channels = 1
+            c = new_codec(int(id_), name, media, int(clockrate))
+            channels = codec.getAttr('channels')
+            c.channels = int(channels) if channels else 1
             for p in codec.iterTags('parameter'):
                 c.add_optional_parameter(p['name'], str(p['value']))
             codecs.append(c)
@@ -299,6 +355,17 @@ class JingleRTPContent(JingleContent):
                 raise FailedApplication
 
     def iter_codecs(self):
+        if not self._codecs:
+            # Nothing is cached as long as farstream knows no codecs
+            self._codecs = list(self._get_codecs())
+        # Every description needs its own nodes, a node can only have
+        # one parent
+        for attrs, params in self._codecs:
+            payload = [nbxmpp.Node('parameter', {'name': name, 'value': value})
+                       for name, value in params]
+            yield nbxmpp.Node('payload-type', dict(attrs), payload)
+
+    def _get_codecs(self):
         codecs = self.p2psession.props.codecs_without_config
         for codec in codecs:
             attrs = {
@@ -309,13 +376,9 @@ class JingleRTPContent(JingleContent):
                 attrs['channels'] = codec.channels
             if codec.clock_rate:
                 attrs['clockrate'] = codec.clock_rate
-            if codec.optional_params:
-                payload = [nbxmpp.Node('parameter',
-                                       {'name': p.name, 'value': p.value})
-                           for p in codec.optional_params]
-            else:
-                payload = []
-            yield nbxmpp.Node('payload-type', attrs, payload)
+            params = tuple((p.name, p.value)
+                           for p in codec.optional_params or ())
+            yield attrs, params
 
     def __stop(self, *things):
         self.pipeline.set_state(Gst.State.NULL)
@@ -352,6 +415,9 @@ class JingleAudio(JingleRTPContent):
         self.out_volume.set_property('volume', vol)
 
     def setup_stream(self):
+        audio_input_device = app.config.get('audio_input_device')
+        audio_output_device = app.config.get('audio_output_device')
+
         JingleRTPContent.setup_stream(self, self._on_src_pad_added)
 
         # list of codecs that are explicitly allowed
@@ -389,13 +455,13 @@ class JingleAudio(JingleRTPContent):
 
         # the local parts
         # TODO: Add queues?
-        self.src_bin = self.make_bin_from_config('audio_input_device',
-                                                 '%s ! audioconvert',
-                                                 _("audio input"))
+        self.src_bin = self.make_bin(audio_input_device,
+                                     '%s ! audioconvert',
+                                     _("audio input"))
 
-        self.sink = self.make_bin_from_config('audio_output_device',
-                                              'audioconvert ! volume name=gajim_out_vol ! %s',
-                                              _("audio output"))
+        self.sink = self.make_bin(audio_output_device,
+                                  'audioconvert ! volume name=gajim_out_vol ! %s',
+                                  _("audio output"))
 
         self.mic_volume = self.src_bin.get_by_name('gajim_vol')
         self.out_volume = self.sink.get_by_name('gajim_out_vol')
@@ -417,6 +483,7 @@ class JingleVideo(JingleRTPContent):
         self.in_xid = in_xid
         self.out_xid = out_xid
         self.out_xid_set = False
+        self._see_self = False
         self.setup_stream()
 
     def setup_stream(self):
@@ -424,14 +491,18 @@ class JingleVideo(JingleRTPContent):
         # sometimes, one window won't show up,
         # sometimes it'll freeze...
         JingleRTPContent.setup_stream(self, self._on_src_pad_added)
+        self._see_self = app.config.get('video_see_self')
         bus = self.pipeline.get_bus()
         bus.enable_sync_message_emission()
         bus.connect('sync-message::element', self._on_sync_message)
 
         # the local parts
-        if app.config.get('video_framerate'):
+        video_input_device = app.config.get('video_input_device')
+        video_output_device = app.config.get('video_output_device')
+        video_framerate = app.config.get('video_framerate')
+        if video_framerate:
             framerate = 'videorate ! video/x-raw,framerate=%s ! ' % \
-                app.config.get('video_framerate')
+                video_framerate
         else:
             framerate = ''
         try:
@@ -442,25 +513,24 @@ class JingleVideo(JingleRTPContent):
             video_size = 'video/x-raw,width=%s,height=%s ! ' % (w, h)
         else:
             video_size = ''
-        if app.config.get('video_see_self'):
+        if self._see_self:
             tee = '! tee name=t ! queue ! videoscale ! ' + \
                 'video/x-raw,width=160,height=120 ! videoconvert ! ' + \
-                '%s t. ! queue ' % app.config.get(
-                    'video_output_device')
+                '%s t. ! queue ' % video_output_device
         else:
             tee = ''
 
-        self.src_bin = self.make_bin_from_config('video_input_device',
-                                                 '%%s %s! %svideoscale ! %svideoconvert' %
-                                                 (tee, framerate, video_size),
-                                                 _("video input"))
+        self.src_bin = self.make_bin(video_input_device,
+                                     '%%s %s! %svideoscale ! %svideoconvert' %
+                                     (tee, framerate, video_size),
+                                     _("video input"))
 
         self.pipeline.add(self.src_bin)
         self.pipeline.set_state(Gst.State.PLAYING)
 
-        self.sink = self.make_bin_from_config('video_output_device',
-                                              'videoscale ! videoconvert ! %s',
-                                              _("video output"))
+        self.sink = self.make_bin(video_output_device,
+                                  'videoscale ! videoconvert ! %s',
+                                  _("video output"))
 
         self.pipeline.add(self.sink)
 
@@ -471,12 +541,13 @@ class JingleVideo(JingleRTPContent):
         self.pipeline.set_state(Gst.State.PLAYING)
 
     def _on_sync_message(self, bus, message):
-        if message.get_structure() is None:
+        structure = message.get_structure()
+        if structure is None:
             return False
-        if message.get_structure().get_name() == 'prepare-window-handle':
+        if structure.get_name() == 'prepare-window-handle':
             message.src.set_property('force-aspect-ratio', True)
             imagesink = message.src
-            if app.config.get('video_see_self') and not self.out_xid_set:
+            if self._see_self and not self.out_xid_set:
                 imagesink.set_window_handle(self.out_xid)
                 self.out_xid_set = True
             else:
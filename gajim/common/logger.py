@@ -27,15 +27,22 @@ This module allows to access the on-disk database of logs
 
 import os
 import sys
+import stat
 import time
 import math
 import datetime
 import calendar
 import json
 import logging
+import functools
 import sqlite3 as sqlite
 from collections import namedtuple
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from gi.repository import GLib
 
 from nbxmpp.protocol import Node
@@ -57,6 +64,10 @@ from gajim.common.structs import CapsData
 from gajim.common.structs import CapsIdentity
 
 
+# Latest schema versions, must match the PRAGMA user_version set below
+LOGS_USER_VERSION = 5
+CACHE_USER_VERSION = 4
+
 LOGS_SQL_STATEMENT = '''
     CREATE TABLE jids(
             jid_id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
@@ -140,31 +151,119 @@ CACHE_SQL_STATEMENT = '''
 
 log = logging.getLogger('gajim.c.logger')
 
+SHOW_TO_DB_API = {
+    'online': ShowConstant.ONLINE,
+    'chat': ShowConstant.CHAT,
+    'away': ShowConstant.AWAY,
+    'xa': ShowConstant.XA,
+    'dnd': ShowConstant.DND,
+    'offline': ShowConstant.OFFLINE,
+}
+
+TRANSPORT_TYPE_TO_DB_API = {
+    'aim': TypeConstant.AIM,
+    'gadu-gadu': TypeConstant.GG,
+    'http-ws': TypeConstant.HTTP_WS,
+    'icq': TypeConstant.ICQ,
+    'msn': TypeConstant.MSN,
+    'qq': TypeConstant.QQ,
+    'sms': TypeConstant.SMS,
+    'smtp': TypeConstant.SMTP,
+    'tlen': TypeConstant.TLEN,
+    'x-tlen': TypeConstant.TLEN,
+    'newmail': TypeConstant.NEWMAIL,
+    'rss': TypeConstant.RSS,
+    'weather': TypeConstant.WEATHER,
+    'mrim': TypeConstant.MRIM,
+    'jabber': TypeConstant.NO_TRANSPORT,
+}
+
+DB_API_TO_TRANSPORT_TYPE = {
+    type_id: type_ for type_, type_id in TRANSPORT_TYPE_TO_DB_API.items()
+    if type_ != 'x-tlen'
+}
+
+SUBSCRIPTION_TO_DB_API = {
+    'none': SubscriptionConstant.NONE,
+    'to': SubscriptionConstant.TO,
+    'from': SubscriptionConstant.FROM,
+    'both': SubscriptionConstant.BOTH,
+}
+
+DB_API_TO_SUBSCRIPTION = {
+    sub_id: sub for sub, sub_id in SUBSCRIPTION_TO_DB_API.items()
+}
+
+MARKER_STATES = ('received', 'displayed')
+
+ONE_DAY = datetime.timedelta(days=1)
+
+# Kinds inlined into the history queries
+RESTORE_KINDS_SQL = ', '.join(map(str, [KindConstant.SINGLE_MSG_RECV,
+                                        KindConstant.SINGLE_MSG_SENT,
+                                        KindConstant.CHAT_MSG_RECV,
+                                        KindConstant.CHAT_MSG_SENT,
+                                        KindConstant.ERROR]))
+STATUS_KINDS_SQL = ', '.join(map(str, [KindConstant.STATUS,
+                                       KindConstant.GCSTATUS]))
+
+# The logger issues more distinct statements than fit into the default
+# statement cache of sqlite3 (100), e.g. one per family size for every
+# history query
+STATEMENT_CACHE_SIZE = 256
+
+# Shared by single roster pushes and full roster replacements
+ROSTER_ENTRY_SQL = '''REPLACE INTO roster_entry
+                      (account_jid_id, jid_id, name, subscription, ask)
+                      VALUES(?, ?, ?, ?, ?)'''
+ROSTER_GROUP_SQL = '''INSERT INTO roster_group
+                      (account_jid_id, jid_id, group_name)
+                      VALUES (?, ?, ?)'''
+
+
+if orjson is not None:
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode()
+else:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
+
+def _stat_or_none(path):
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
 
 
-class CapsEncoder(json.JSONEncoder):
-    def encode(self, obj):
-        if isinstance(obj, DiscoInfo):
-            identities = []
-            for identity in obj.identities:
-                identities.append(
-                    {'category': identity.category,
-                     'type': identity.type,
-                     'name': identity.name,
-                     'lang': identity.lang})
+def _caps_to_dict(obj):
+    """
+    Convert a DiscoInfo into the dict which is stored in the caps cache
+    """
+    if not isinstance(obj, DiscoInfo):
+        return obj
 
-            dataforms = []
-            for dataform in obj.dataforms:
-                # Filter out invalid forms according to XEP-0115
-                form_type = dataform.vars.get('FORM_TYPE')
-                if form_type is None or form_type.type_ != 'hidden':
-                    continue
-                dataforms.append(str(dataform))
+    identities = []
+    for identity in obj.identities:
+        identities.append(
+            {'category': identity.category,
+             'type': identity.type,
+             'name': identity.name,
+             'lang': identity.lang})
 
-            obj = {'identities': identities,
-                   'features': obj.features,
-                   'dataforms': dataforms}
-        return json.JSONEncoder.encode(self, obj)
+    dataforms = []
+    for dataform in obj.dataforms:
+        # Filter out invalid forms according to XEP-0115
+        form_type = dataform.vars.get('FORM_TYPE')
+        if form_type is None or form_type.type_ != 'hidden':
+            continue
+        dataforms.append(str(dataform))
+
+    return {'identities': identities,
+            'features': obj.features,
+            'dataforms': dataforms}
 
 
 def caps_decoder(dict_):
@@ -185,16 +284,49 @@ def caps_decoder(dict_):
                     dataforms=dataforms)
 
 def timeit(func):
+    @functools.wraps(func)
     def func_wrapper(self, *args, **kwargs):
-        start = time.time() / 1e9
+        start = time.perf_counter()
         result = func(self, *args, **kwargs)
-        exec_time = (time.time() / 1e9 - start)
-        level = 30 if exec_time > 50 else 10
+        exec_time = (time.perf_counter() - start) * 1000
+        level = logging.WARNING if exec_time > 50 else logging.DEBUG
         log.log(level, 'Execution time for %s: %s ms',
                 func.__name__, math.ceil(exec_time))
         return result
     return func_wrapper
 
+class _AdditionalDataField:
+    """
+    Decode the additional_data column of a row on first access and store
+    the AdditionalDataDict on the row
+    """
+
+    def __init__(self, index):
+        self._index = index
+
+    def __get__(self, row, owner=None):
+        if row is None:
+            return self
+        _dict = _json_loads(row[self._index] or '{}')
+        additional_data = AdditionalDataDict(_dict)
+        row.__dict__['additional_data'] = additional_data
+        return additional_data
+
+
+@functools.lru_cache(maxsize=None)
+def _get_row_class(fields):
+    """
+    Return the namedtuple class for rows with the given column names, so it
+    is only created once for every query shape
+    """
+    Row = namedtuple('Row', fields)
+    if 'additional_data' not in fields:
+        return Row
+
+    index = fields.index('additional_data')
+    return type('Row', (Row,), {
+        'additional_data': _AdditionalDataField(index)})
+
 def _convert_disco_info(disco_info):
     return parse_disco_info(Iq(node=disco_info))
 
@@ -208,7 +340,8 @@ def _adapt_common_error(common_error):
     return common_error.serialize()
 
 def _convert_marker(marker):
-    return 'received' if marker == 0 else 'displayed'
+    # Converters get the raw column value as bytes
+    return MARKER_STATES[int(marker)]
 
 sqlite.register_converter('disco_info', _convert_disco_info)
 sqlite.register_adapter(DiscoInfo, _adapt_disco_info)
@@ -222,7 +355,8 @@ sqlite.register_converter('marker', _convert_marker)
 class Logger:
     def __init__(self):
         self._jid_ids = {}
-        self._jid_ids_reversed = {}
+        self._jid_types = {}
+        self._jids_not_in_db = set()
         self._con = None
         self._commit_timout_id = None
         self._log_db_path = configpaths.get('LOG_DB')
@@ -236,22 +370,22 @@ class Logger:
         self._get_jid_ids_from_db()
 
     def _create_databases(self):
-        if os.path.isdir(self._log_db_path):
-            log.error(_('%s is a directory but should be a file'),
-                      self._log_db_path)
-            sys.exit()
+        log_db_stat = _stat_or_none(self._log_db_path)
+        cache_db_stat = _stat_or_none(self._cache_db_path)
 
-        if os.path.isdir(self._cache_db_path):
-            log.error(_('%s is a directory but should be a file'),
-                      self._cache_db_path)
-            sys.exit()
+        for path, st in ((self._log_db_path, log_db_stat),
+                         (self._cache_db_path, cache_db_stat)):
+            if st is not None and stat.S_ISDIR(st.st_mode):
+                log.error(_('%s is a directory but should be a file'), path)
+                sys.exit()
 
-        if not os.path.exists(self._log_db_path):
-            if os.path.exists(self._cache_db_path):
+        if log_db_stat is None:
+            if cache_db_stat is not None:
                 os.remove(self._cache_db_path)
+                cache_db_stat = None
             self._create(LOGS_SQL_STATEMENT, self._log_db_path)
 
-        if not os.path.exists(self._cache_db_path):
+        if cache_db_stat is None:
             self._create(CACHE_SQL_STATEMENT, self._cache_db_path)
 
     @staticmethod
@@ -297,7 +431,11 @@ class Logger:
 
     @timeit
     def _migrate_logs(self, con):
-        if self._get_user_version(con) == 0:
+        user_version = self._get_user_version(con)
+        if user_version >= LOGS_USER_VERSION:
+            return
+
+        if user_version == 0:
             # All migrations from 0.16.9 until 1.0.0
             statements = [
                 'ALTER TABLE logs ADD COLUMN "account_id" INTEGER',
@@ -350,7 +488,11 @@ class Logger:
 
     @timeit
     def _migrate_cache(self, con):
-        if self._get_user_version(con) == 0:
+        user_version = self._get_user_version(con)
+        if user_version >= CACHE_USER_VERSION:
+            return
+
+        if user_version == 0:
             # All migrations from 0.16.9 until 1.0.0
             statements = [
                 'ALTER TABLE roster_entry ADD COLUMN "avatar_sha" TEXT',
@@ -388,9 +530,20 @@ class Logger:
     @staticmethod
     def _execute_multiple(con, statements):
         """
-        Execute mutliple statements with the option to fail on duplicates
+        Execute mutliple statements in one transaction, fall back to
+        executing them one by one with the option to fail on duplicates
         but still continue
         """
+        script = 'BEGIN;\n{};\nCOMMIT;'.format(';\n'.join(statements))
+        try:
+            con.executescript(script)
+            return
+        except sqlite.OperationalError as error:
+            con.rollback()
+            if not str(error).startswith('duplicate column name:'):
+                log.exception('Error')
+                sys.exit()
+
         for sql in statements:
             try:
                 con.execute(sql)
@@ -402,26 +555,15 @@ class Logger:
                     log.exception('Error')
                     sys.exit()
 
-    def namedtuple_factory(self, cursor, row):
+    @staticmethod
+    def namedtuple_factory(cursor, row):
         """
         Usage:
         con.row_factory = namedtuple_factory
         """
-        fields = [col[0] for col in cursor.description]
-        Row = namedtuple("Row", fields)
-        named_row = Row(*row)
-        if 'additional_data' in fields:
-            _dict = json.loads(named_row.additional_data or '{}')
-            named_row = named_row._replace(
-                additional_data=AdditionalDataDict(_dict))
-
-        # if an alias `account` for the field `account_id` is used for the
-        # query, the account_id is converted to the account jid
-        if 'account' in fields:
-            if named_row.account:
-                jid = self._jid_ids_reversed[named_row.account].jid
-                named_row = named_row._replace(account=jid)
-        return named_row
+        fields = tuple(col[0] for col in cursor.description)
+        Row = _get_row_class(fields)
+        return Row(*row)
 
     def dispatch(self, event, error):
         app.ged.raise_event(event, None, str(error))
@@ -430,15 +572,14 @@ class Logger:
         self._con = self._connect(self._log_db_path,
                                   timeout=20.0,
                                   isolation_level='IMMEDIATE',
-                                  detect_types=sqlite.PARSE_COLNAMES)
+                                  detect_types=sqlite.PARSE_COLNAMES,
+                                  cached_statements=STATEMENT_CACHE_SIZE)
 
         self._con.row_factory = self.namedtuple_factory
 
         # DB functions
-        self._con.create_function("like", 1, self._like)
         self._con.create_function("get_timeout", 0, self._get_timeout)
 
-        self._set_synchronous(False)
         try:
             self._con.execute("ATTACH DATABASE '%s' AS cache" %
                               self._cache_db_path.replace("'", "''"))
@@ -447,13 +588,21 @@ class Logger:
             self._con.close()
             sys.exit()
 
+        self._set_journal_mode()
+
     @timeit
-    def _set_synchronous(self, sync):
+    def _set_journal_mode(self):
+        # With WAL a commit only appends to the log file. synchronous =
+        # NORMAL syncs on checkpoints, in WAL mode this keeps the database
+        # consistent, only the last commits can be lost on a power failure
         try:
-            if sync:
-                self._con.execute("PRAGMA synchronous = NORMAL")
-            else:
-                self._con.execute("PRAGMA synchronous = OFF")
+            self._con.execute('PRAGMA temp_store = MEMORY')
+            # Negative values are KiB, the default cache is only 2MB which
+            # is too small to hold the indexes of a big history
+            self._con.execute('PRAGMA main.cache_size = -20000')
+            for schema in ('main', 'cache'):
+                self._con.execute('PRAGMA %s.journal_mode = WAL' % schema)
+                self._con.execute('PRAGMA %s.synchronous = NORMAL' % schema)
         except sqlite.Error:
             log.exception('Error')
 
@@ -469,10 +618,6 @@ class Logger:
             timeout = now - (timeout * 60)
         return timeout
 
-    @staticmethod
-    def _like(search_str):
-        return '%{}%'.format(search_str)
-
     @timeit
     def commit(self):
         try:
@@ -488,11 +633,11 @@ class Logger:
         self._commit_timout_id = GLib.timeout_add(500, self.commit)
 
     @timeit
-    def simple_commit(self, sql_to_commit):
+    def simple_commit(self, sql_to_commit, parameters=()):
         """
         Helper to commit
         """
-        self._con.execute(sql_to_commit)
+        self._con.execute(sql_to_commit, parameters)
         self._timeout_commit()
 
     @timeit
@@ -500,11 +645,11 @@ class Logger:
         """
         Load all jid/jid_id tuples into a dict for faster access
         """
-        rows = self._con.execute(
-            'SELECT jid_id, jid, type FROM jids').fetchall()
-        for row in rows:
-            self._jid_ids[row.jid] = row
-            self._jid_ids_reversed[row.jid_id] = row
+        cursor = self._con.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute('SELECT jid_id, jid, type FROM jids').fetchall()
+        self._jid_ids = {jid: jid_id for jid_id, jid, _type in rows}
+        self._jid_types = {jid: type_ for _jid_id, jid, type_ in rows}
 
     def get_jids_in_db(self):
         return self._jid_ids.keys()
@@ -528,10 +673,10 @@ class Logger:
         """
         Return True if it's a room jid, False if it's not, None if we don't know
         """
-        jid_ = self._jid_ids.get(jid)
-        if jid_ is None:
+        type_ = self._jid_types.get(jid)
+        if type_ is None:
             return
-        return jid_.type == JIDConstant.ROOM_TYPE
+        return type_ == JIDConstant.ROOM_TYPE
 
     @staticmethod
     def _get_family_jids(account, jid):
@@ -549,6 +694,23 @@ class Logger:
             return [user['jid'] for user in family]
         return [jid]
 
+    def _get_family_jid_ids(self, account, jid):
+        """
+        Get the jid ids of all jids of the metacontacts family
+
+        JIDs which are not in the database are skipped, because there
+        can be no messages for them
+
+        returns a list of jid ids
+        """
+        jid_ids = []
+        for family_jid in self._get_family_jids(account, jid):
+            try:
+                jid_ids.append(self.get_jid_id(family_jid))
+            except ValueError:
+                continue
+        return jid_ids
+
     def get_account_id(self, account):
         jid = app.get_jid_from_account(account)
         return self.get_jid_id(jid, type_=JIDConstant.NORMAL_TYPE)
@@ -573,24 +735,30 @@ class Logger:
         elif kind is not None:
             type_ = JIDConstant.NORMAL_TYPE
 
-        result = self._jid_ids.get(jid, None)
-        if result is not None:
-            return result.jid_id
+        jid_id = self._jid_ids.get(jid)
+        if jid_id is not None:
+            return jid_id
 
-        sql = 'SELECT jid_id, jid, type FROM jids WHERE jid = ?'
-        row = self._con.execute(sql, [jid]).fetchone()
-        if row is not None:
-            self._jid_ids[jid] = row
-            return row.jid_id
+        if jid not in self._jids_not_in_db:
+            sql = 'SELECT jid_id, type FROM jids WHERE jid = ?'
+            row = self._con.execute(sql, [jid]).fetchone()
+            if row is not None:
+                self._jid_ids[jid] = row.jid_id
+                self._jid_types[jid] = row.type
+                return row.jid_id
 
         if type_ is None:
+            # Remember the miss, so lookups for JIDs we have no history
+            # with don't query the database every time
+            self._jids_not_in_db.add(jid)
             raise ValueError(
                 'Unable to insert new JID because type is missing')
 
         sql = 'INSERT INTO jids (jid, type) VALUES (?, ?)'
         lastrowid = self._con.execute(sql, (jid, type_)).lastrowid
-        Row = namedtuple('Row', 'jid_id jid type')
-        self._jid_ids[jid] = Row(lastrowid, jid, type_)
+        self._jid_ids[jid] = lastrowid
+        self._jid_types[jid] = type_
+        self._jids_not_in_db.discard(jid)
         self._timeout_commit()
         return lastrowid
 
@@ -598,117 +766,35 @@ class Logger:
         """
         Convert from string style to constant ints for db
         """
-
-        if show == 'online':
-            return ShowConstant.ONLINE
-        if show == 'chat':
-            return ShowConstant.CHAT
-        if show == 'away':
-            return ShowConstant.AWAY
-        if show == 'xa':
-            return ShowConstant.XA
-        if show == 'dnd':
-            return ShowConstant.DND
-        if show == 'offline':
-            return ShowConstant.OFFLINE
         if show is None:
             return ShowConstant.ONLINE
         # invisible in GC when someone goes invisible
         # it's a RFC violation .... but we should not crash
-        return None
+        return SHOW_TO_DB_API.get(show)
 
     def convert_human_transport_type_to_db_api_values(self, type_):
         """
         Convert from string style to constant ints for db
         """
-        if type_ == 'aim':
-            return TypeConstant.AIM
-        if type_ == 'gadu-gadu':
-            return TypeConstant.GG
-        if type_ == 'http-ws':
-            return TypeConstant.HTTP_WS
-        if type_ == 'icq':
-            return TypeConstant.ICQ
-        if type_ == 'msn':
-            return TypeConstant.MSN
-        if type_ == 'qq':
-            return TypeConstant.QQ
-        if type_ == 'sms':
-            return TypeConstant.SMS
-        if type_ == 'smtp':
-            return TypeConstant.SMTP
-        if type_ in ('tlen', 'x-tlen'):
-            return TypeConstant.TLEN
-        if type_ == 'newmail':
-            return TypeConstant.NEWMAIL
-        if type_ == 'rss':
-            return TypeConstant.RSS
-        if type_ == 'weather':
-            return TypeConstant.WEATHER
-        if type_ == 'mrim':
-            return TypeConstant.MRIM
-        if type_ == 'jabber':
-            return TypeConstant.NO_TRANSPORT
-        return None
+        return TRANSPORT_TYPE_TO_DB_API.get(type_)
 
     def convert_api_values_to_human_transport_type(self, type_id):
         """
         Convert from constant ints for db to string style
         """
-        if type_id == TypeConstant.AIM:
-            return 'aim'
-        if type_id == TypeConstant.GG:
-            return 'gadu-gadu'
-        if type_id == TypeConstant.HTTP_WS:
-            return 'http-ws'
-        if type_id == TypeConstant.ICQ:
-            return 'icq'
-        if type_id == TypeConstant.MSN:
-            return 'msn'
-        if type_id == TypeConstant.QQ:
-            return 'qq'
-        if type_id == TypeConstant.SMS:
-            return 'sms'
-        if type_id == TypeConstant.SMTP:
-            return 'smtp'
-        if type_id == TypeConstant.TLEN:
-            return 'tlen'
-        if type_id == TypeConstant.NEWMAIL:
-            return 'newmail'
-        if type_id == TypeConstant.RSS:
-            return 'rss'
-        if type_id == TypeConstant.WEATHER:
-            return 'weather'
-        if type_id == TypeConstant.MRIM:
-            return 'mrim'
-        if type_id == TypeConstant.NO_TRANSPORT:
-            return 'jabber'
+        return DB_API_TO_TRANSPORT_TYPE.get(type_id)
 
     def convert_xmpp_sub(self, sub):
         """
         Convert from string style to constant ints for db
         """
-        if sub == 'none':
-            return SubscriptionConstant.NONE
-        if sub == 'to':
-            return SubscriptionConstant.TO
-        if sub == 'from':
-            return SubscriptionConstant.FROM
-        if sub == 'both':
-            return SubscriptionConstant.BOTH
+        return SUBSCRIPTION_TO_DB_API.get(sub)
 
     def convert_db_sub(self, sub):
         """
         Convert from constant ints for db to string style
         """
-        if sub == SubscriptionConstant.NONE:
-            return 'none'
-        if sub == SubscriptionConstant.TO:
-            return 'to'
-        if sub == SubscriptionConstant.FROM:
-            return 'from'
-        if sub == SubscriptionConstant.BOTH:
-            return 'both'
+        return DB_API_TO_SUBSCRIPTION.get(sub)
 
     @timeit
     def insert_unread_events(self, message_id, jid_id):
@@ -725,18 +811,17 @@ class Logger:
         """
         Mark all messages with ids in message_ids as read
         """
-        ids = ','.join([str(i) for i in message_ids])
-        sql = 'DELETE FROM unread_messages WHERE message_id IN (%s)' % ids
-        self.simple_commit(sql)
+        sql = 'DELETE FROM unread_messages WHERE message_id = ?'
+        self._con.executemany(sql, [(id_,) for id_ in message_ids])
+        self._timeout_commit()
 
     @timeit
     def set_shown_unread_msgs(self, msg_log_id):
         """
         Mark unread message as shown un GUI
         """
-        sql = 'UPDATE unread_messages SET shown = 1 where message_id = %s' % \
-                msg_log_id
-        self.simple_commit(sql)
+        sql = 'UPDATE unread_messages SET shown = 1 where message_id = ?'
+        self.simple_commit(sql, (msg_log_id,))
 
     @timeit
     def reset_shown_unread_messages(self):
@@ -752,6 +837,7 @@ class Logger:
         Get all unread messages
         """
         all_messages = []
+        removed_ids = []
         try:
             unread_results = self._con.execute(
                 'SELECT message_id, shown from unread_messages').fetchall()
@@ -767,15 +853,17 @@ class Logger:
                     SELECT logs.log_line_id, logs.message, logs.time, logs.subject,
                     jids.jid, logs.additional_data
                     FROM logs, jids
-                    WHERE logs.log_line_id = %d AND logs.jid_id = jids.jid_id
-                    ''' % msg_log_id
-                    ).fetchone()
+                    WHERE logs.log_line_id = ? AND logs.jid_id = jids.jid_id
+                    ''', (msg_log_id,)).fetchone()
             if result is None:
                 # Log line is no more in logs table. remove it from unread_messages
-                self.set_read_messages([msg_log_id])
+                removed_ids.append(msg_log_id)
                 continue
 
             all_messages.append((result, shown))
+
+        if removed_ids:
+            self.set_read_messages(removed_ids)
         return all_messages
 
     @timeit
@@ -803,27 +891,21 @@ class Logger:
         if restore <= 0:
             return []
 
-        kinds = map(str, [KindConstant.SINGLE_MSG_RECV,
-                          KindConstant.SINGLE_MSG_SENT,
-                          KindConstant.CHAT_MSG_RECV,
-                          KindConstant.CHAT_MSG_SENT,
-                          KindConstant.ERROR])
-
-        jids = self._get_family_jids(account, jid)
+        jid_ids = self._get_family_jid_ids(account, jid)
 
         sql = '''
             SELECT time, kind, message, error as "error [common_error]",
                    subject, additional_data, marker as "marker [marker]",
                    message_id
-            FROM logs NATURAL JOIN jids WHERE jid IN ({jids}) AND
+            FROM logs WHERE jid_id IN ({jid_ids}) AND
             kind IN ({kinds}) AND time > get_timeout()
             ORDER BY time DESC, log_line_id DESC LIMIT ? OFFSET ?
-            '''.format(jids=', '.join('?' * len(jids)),
-                       kinds=', '.join(kinds))
+            '''.format(jid_ids=', '.join('?' * len(jid_ids)),
+                       kinds=RESTORE_KINDS_SQL)
 
         try:
             messages = self._con.execute(
-                sql, tuple(jids) + (restore, pending)).fetchall()
+                sql, tuple(jid_ids) + (restore, pending)).fetchall()
         except sqlite.DatabaseError:
             self.dispatch('DB_ERROR',
                           exceptions.DatabaseMalformed(self._log_db_path))
@@ -857,22 +939,23 @@ class Logger:
         returns a list of namedtuples
         """
 
-        jids = self._get_family_jids(account, jid)
-
-        delta = datetime.timedelta(
-            hours=23, minutes=59, seconds=59, microseconds=999999)
+        jid_ids = self._get_family_jid_ids(account, jid)
+        if not jid_ids:
+            # None of the JIDs has a history
+            return []
 
         sql = '''
             SELECT contact_name, time, kind, show, message, subject,
                    additional_data, log_line_id
-            FROM logs NATURAL JOIN jids WHERE jid IN ({jids})
-            AND time BETWEEN ? AND ?
+            FROM logs WHERE jid_id IN ({jid_ids})
+            AND time >= ? AND time < ?
             ORDER BY time, log_line_id
-            '''.format(jids=', '.join('?' * len(jids)))
+            '''.format(jid_ids=', '.join('?' * len(jid_ids)))
 
-        return self._con.execute(sql, tuple(jids) +
+        end = date + ONE_DAY
+        return self._con.execute(sql, tuple(jid_ids) +
                                       (date.timestamp(),
-                                      (date + delta).timestamp())).fetchall()
+                                       end.timestamp())).fetchall()
 
     @timeit
     def search_log(self, account, jid, query, date=None):
@@ -894,27 +977,28 @@ class Logger:
 
         returns a list of namedtuples
         """
-        jids = self._get_family_jids(account, jid)
+        jid_ids = self._get_family_jid_ids(account, jid)
+        if not jid_ids:
+            # None of the JIDs has a history
+            return []
+        params = tuple(jid_ids) + ('%{}%'.format(query),)
 
+        date_search = ''
         if date:
-            delta = datetime.timedelta(
-                hours=23, minutes=59, seconds=59, microseconds=999999)
-
-            between = '''
-                AND time BETWEEN {start} AND {end}
-                '''.format(start=date.timestamp(),
-                           end=(date + delta).timestamp())
+            date_search = 'AND time >= ? AND time < ?'
+            end = date + ONE_DAY
+            params += (date.timestamp(), end.timestamp())
 
         sql = '''
         SELECT contact_name, time, kind, show, message, subject,
                additional_data, log_line_id
-        FROM logs NATURAL JOIN jids WHERE jid IN ({jids})
-        AND message LIKE like(?) {date_search}
+        FROM logs WHERE jid_id IN ({jid_ids})
+        AND message LIKE ? {date_search}
         ORDER BY time, log_line_id
-        '''.format(jids=', '.join('?' * len(jids)),
-                   date_search=between if date else '')
+        '''.format(jid_ids=', '.join('?' * len(jid_ids)),
+                   date_search=date_search)
 
-        return self._con.execute(sql, tuple(jids) + (query,)).fetchall()
+        return self._con.execute(sql, params).fetchall()
 
     @timeit
     def get_days_with_logs(self, account, jid, year, month):
@@ -932,28 +1016,26 @@ class Logger:
 
         returns a list of namedtuples
         """
-        jids = self._get_family_jids(account, jid)
-
-        kinds = map(str, [KindConstant.STATUS,
-                          KindConstant.GCSTATUS])
+        jid_ids = self._get_family_jid_ids(account, jid)
+        if not jid_ids:
+            # None of the JIDs has a history
+            return []
 
         # Calculate the start and end datetime of the month
         date = datetime.datetime(year, month, 1)
-        days = calendar.monthrange(year, month)[1] - 1
-        delta = datetime.timedelta(
-            days=days, hours=23, minutes=59, seconds=59, microseconds=999999)
+        days = calendar.monthrange(year, month)[1]
+        delta = datetime.timedelta(days=days)
 
         sql = """
             SELECT DISTINCT 
             CAST(strftime('%d', time, 'unixepoch', 'localtime') AS INTEGER)
-            AS day FROM logs NATURAL JOIN jids WHERE jid IN ({jids})
-            AND time BETWEEN ? AND ?
+            AS day FROM logs WHERE jid_id IN ({jid_ids})
+            AND time >= ? AND time < ?
             AND kind NOT IN ({kinds})
-            ORDER BY time
-            """.format(jids=', '.join('?' * len(jids)),
-                       kinds=', '.join(kinds))
+            """.format(jid_ids=', '.join('?' * len(jid_ids)),
+                       kinds=STATUS_KINDS_SQL)
 
-        return self._con.execute(sql, tuple(jids) +
+        return self._con.execute(sql, tuple(jid_ids) +
                                       (date.timestamp(),
                                       (date + delta).timestamp())).fetchall()
 
@@ -968,21 +1050,18 @@ class Logger:
 
         returns a timestamp or None
         """
-        jids = self._get_family_jids(account, jid)
-
-        kinds = map(str, [KindConstant.STATUS,
-                          KindConstant.GCSTATUS])
+        jid_ids = self._get_family_jid_ids(account, jid)
 
         sql = '''
             SELECT MAX(time) as time FROM logs
-            NATURAL JOIN jids WHERE jid IN ({jids})
+            WHERE jid_id IN ({jid_ids})
             AND kind NOT IN ({kinds})
-            '''.format(jids=', '.join('?' * len(jids)),
-                       kinds=', '.join(kinds))
+            '''.format(jid_ids=', '.join('?' * len(jid_ids)),
+                       kinds=STATUS_KINDS_SQL)
 
         # fetchone() returns always at least one Row with all
         # attributes set to None because of the MAX() function
-        return self._con.execute(sql, tuple(jids)).fetchone().time
+        return self._con.execute(sql, tuple(jid_ids)).fetchone().time
 
     @timeit
     def get_first_date_that_has_logs(self, account, jid):
@@ -995,21 +1074,18 @@ class Logger:
 
         returns a timestamp or None
         """
-        jids = self._get_family_jids(account, jid)
-
-        kinds = map(str, [KindConstant.STATUS,
-                          KindConstant.GCSTATUS])
+        jid_ids = self._get_family_jid_ids(account, jid)
 
         sql = '''
             SELECT MIN(time) as time FROM logs
-            NATURAL JOIN jids WHERE jid IN ({jids})
+            WHERE jid_id IN ({jid_ids})
             AND kind NOT IN ({kinds})
-            '''.format(jids=', '.join('?' * len(jids)),
-                       kinds=', '.join(kinds))
+            '''.format(jid_ids=', '.join('?' * len(jid_ids)),
+                       kinds=STATUS_KINDS_SQL)
 
         # fetchone() returns always at least one Row with all
         # attributes set to None because of the MIN() function
-        return self._con.execute(sql, tuple(jids)).fetchone().time
+        return self._con.execute(sql, tuple(jid_ids)).fetchone().time
 
     @timeit
     def get_date_has_logs(self, account, jid, date):
@@ -1026,22 +1102,22 @@ class Logger:
 
         returns a timestamp or None
         """
-        jids = self._get_family_jids(account, jid)
-
-        delta = datetime.timedelta(
-            hours=23, minutes=59, seconds=59, microseconds=999999)
+        jid_ids = self._get_family_jid_ids(account, jid)
+        if not jid_ids:
+            # None of the JIDs has a history
+            return None
 
         start = date.timestamp()
-        end = (date + delta).timestamp()
+        end = (date + ONE_DAY).timestamp()
 
         sql = '''
             SELECT time
-            FROM logs NATURAL JOIN jids WHERE jid IN ({jids})
-            AND time BETWEEN ? AND ?
-            '''.format(jids=', '.join('?' * len(jids)))
+            FROM logs WHERE jid_id IN ({jid_ids})
+            AND time >= ? AND time < ? LIMIT 1
+            '''.format(jid_ids=', '.join('?' * len(jid_ids)))
 
         return self._con.execute(
-            sql, tuple(jids) + (start, end)).fetchone()
+            sql, tuple(jid_ids) + (start, end)).fetchone()
 
     @timeit
     def save_transport_type(self, jid, type_):
@@ -1049,19 +1125,10 @@ class Logger:
         Save the type of the transport in DB
         """
         type_id = self.convert_human_transport_type_to_db_api_values(type_)
-        if not type_id:
+        if type_id is None:
             # unknown type
             return
-        result = self._con.execute(
-            'SELECT type from transports_cache WHERE transport = "%s"' % jid).fetchone()
-        if result:
-            if result.type == type_id:
-                return
-            sql = 'UPDATE transports_cache SET type = %d WHERE transport = "%s"' %\
-                    (type_id, jid)
-            self.simple_commit(sql)
-            return
-        sql = 'INSERT INTO transports_cache (transport, type) VALUES (?, ?)'
+        sql = 'REPLACE INTO transports_cache (transport, type) VALUES (?, ?)'
         self._con.execute(sql, (jid, type_id))
         self._timeout_commit()
 
@@ -1084,22 +1151,23 @@ class Logger:
         '''
         Load caps cache data
         '''
-        rows = self._con.execute(
-            'SELECT hash_method, hash, data FROM caps_cache')
+        cursor = self._con.cursor()
+        cursor.row_factory = None
+        cursor.execute('SELECT hash_method, hash, data FROM caps_cache')
 
         cache = {}
-        for row in rows:
+        for hash_method, hash_, data in cursor:
             try:
-                data = json.loads(row.data, object_hook=caps_decoder)
+                data = caps_decoder(_json_loads(data))
             except Exception:
                 log.exception('')
                 continue
-            cache[(row.hash_method, row.hash)] = data
+            cache[(hash_method, hash_)] = data
         return cache
 
     @timeit
     def add_caps_entry(self, hash_method, hash_, caps_data):
-        serialized = json.dumps(caps_data, cls=CapsEncoder)
+        serialized = _json_dumps(_caps_to_dict(caps_data))
         self._con.execute('''
                 INSERT INTO caps_cache (hash_method, hash, data, last_seen)
                 VALUES (?, ?, ?, ?)
@@ -1146,10 +1214,25 @@ class Logger:
         self.remove_roster(account_jid)
 
         # Fill roster tables with the new roster
-        for jid in roster:
-            self.add_or_update_contact(account_jid, jid, roster[jid]['name'],
-                roster[jid]['subscription'], roster[jid]['ask'],
-                roster[jid]['groups'], commit=False)
+        account_jid_id = self.get_jid_id(account_jid)
+        entries = []
+        groups = []
+        for jid, item in roster.items():
+            if item['subscription'] == 'remove':
+                # The old roster is already deleted
+                continue
+            jid_id = self.get_jid_id(jid, type_=JIDConstant.NORMAL_TYPE)
+            entry, group_rows = self._roster_rows(account_jid_id,
+                                                  jid_id,
+                                                  item['name'],
+                                                  item['subscription'],
+                                                  item['ask'],
+                                                  item['groups'])
+            entries.append(entry)
+            groups.extend(group_rows)
+
+        self._con.executemany(ROSTER_ENTRY_SQL, entries)
+        self._con.executemany(ROSTER_GROUP_SQL, groups)
         self._timeout_commit()
 
         # At this point, we are sure the replacement works properly so we can
@@ -1158,7 +1241,7 @@ class Logger:
             roster_version)
 
     @timeit
-    def del_contact(self, account_jid, jid):
+    def del_contact(self, account_jid, jid, commit=True):
         """
         Remove jid from account_jid roster
         """
@@ -1173,7 +1256,20 @@ class Logger:
         self._con.execute(
                 'DELETE FROM roster_entry WHERE account_jid_id=? AND jid_id=?',
                 (account_jid_id, jid_id))
-        self._timeout_commit()
+        if commit:
+            self._timeout_commit()
+
+    def _roster_rows(self, account_jid_id, jid_id, name, sub, ask, groups):
+        """
+        Return the roster_entry row and the roster_group rows of a contact
+        """
+        entry = (account_jid_id,
+                 jid_id,
+                 name or '',
+                 self.convert_xmpp_sub(sub),
+                 bool(ask))
+        group_rows = [(account_jid_id, jid_id, group) for group in groups]
+        return entry, group_rows
 
     @timeit
     def add_or_update_contact(self, account_jid, jid, name, sub, ask, groups,
@@ -1182,7 +1278,7 @@ class Logger:
         Add or update a contact from account_jid roster
         """
         if sub == 'remove':
-            self.del_contact(account_jid, jid)
+            self.del_contact(account_jid, jid, commit=commit)
             return
 
         try:
@@ -1191,27 +1287,17 @@ class Logger:
         except exceptions.PysqliteOperationalError as error:
             raise exceptions.PysqliteOperationalError(str(error))
 
+        entry, group_rows = self._roster_rows(
+            account_jid_id, jid_id, name, sub, ask, groups)
+
         # Update groups information
         # First we delete all previous groups information
         sql = 'DELETE FROM roster_group WHERE account_jid_id=? AND jid_id=?'
         self._con.execute(sql, (account_jid_id, jid_id))
         # Then we add all new groups information
-        sql = '''INSERT INTO roster_group (account_jid_id, jid_id, group_name)
-                 VALUES (?, ?, ?)'''
-        for group in groups:
-            self._con.execute(sql, (account_jid_id, jid_id, group))
-
-        if name is None:
-            name = ''
-
-        sql = '''REPLACE INTO roster_entry
-                 (account_jid_id, jid_id, name, subscription, ask)
-                 VALUES(?, ?, ?, ?, ?)'''
-        self._con.execute(sql, (account_jid_id,
-                                jid_id,
-                                name,
-                                self.convert_xmpp_sub(sub),
-                                bool(ask)))
+        self._con.executemany(ROSTER_GROUP_SQL, group_rows)
+
+        self._con.execute(ROSTER_ENTRY_SQL, entry)
         if commit:
             self._timeout_commit()
 
@@ -1223,40 +1309,33 @@ class Logger:
         data = {}
         account_jid_id = self.get_jid_id(account_jid, type_=JIDConstant.NORMAL_TYPE)
 
+        # Plain tuples, the rows are unpacked right away
+        cursor = self._con.cursor()
+        cursor.row_factory = None
+
         # First we fill data with roster_entry informations
-        rows = self._con.execute('''
-                SELECT j.jid, re.jid_id, re.name, re.subscription, re.ask, re.avatar_sha
+        cursor.execute('''
+                SELECT j.jid, re.name, re.subscription, re.ask, re.avatar_sha
                 FROM roster_entry re, jids j
                 WHERE re.account_jid_id=? AND j.jid_id=re.jid_id''', (account_jid_id,))
-        for row in rows:
-            #jid, jid_id, name, subscription, ask
-            jid = row.jid
-            name = row.name
-            data[jid] = {}
-            data[jid]['avatar_sha'] = row.avatar_sha
-            if name:
-                data[jid]['name'] = name
-            else:
-                data[jid]['name'] = None
-            data[jid]['subscription'] = self.convert_db_sub(row.subscription)
-            data[jid]['groups'] = []
-            data[jid]['resources'] = {}
-            if row.ask:
-                data[jid]['ask'] = 'subscribe'
-            else:
-                data[jid]['ask'] = None
-            data[jid]['id'] = row.jid_id
+        for jid, name, subscription, ask, avatar_sha in cursor:
+            data[jid] = {
+                'avatar_sha': avatar_sha,
+                'name': name or None,
+                'subscription': self.convert_db_sub(subscription),
+                'groups': [],
+                'resources': {},
+                'ask': 'subscribe' if ask else None,
+            }
 
         # Then we add group for roster entries
-        for jid in data:
-            rows = self._con.execute('''
-                    SELECT group_name FROM roster_group
-                    WHERE account_jid_id=? AND jid_id=?''',
-                    (account_jid_id, data[jid]['id']))
-            for row in rows:
-                group_name = row.group_name
+        cursor.execute('''
+                SELECT j.jid, rg.group_name
+                FROM roster_group rg JOIN jids j ON j.jid_id = rg.jid_id
+                WHERE rg.account_jid_id=?''', (account_jid_id,))
+        for jid, group_name in cursor:
+            if jid in data:
                 data[jid]['groups'].append(group_name)
-            del data[jid]['id']
 
         return data
 
@@ -1303,22 +1382,28 @@ class Logger:
         start_time = timestamp - 60
         end_time = timestamp + 60
 
+        try:
+            jid_id = self.get_jid_id(jid)
+        except ValueError:
+            # No messages were ever logged for this JID
+            return False
+
         account_id = self.get_account_id(account)
         log.debug('Search for MUC duplicate')
         log.debug('start: %s, end: %s, jid: %s, resource: %s, message-id: %s',
                   start_time, end_time, jid, resource, message_id)
 
         sql = '''
-            SELECT * FROM logs
-            NATURAL JOIN jids WHERE
-            jid = ? AND
+            SELECT log_line_id FROM logs WHERE
+            jid_id = ? AND
             contact_name = ? AND
             message_id = ? AND
             account_id = ? AND
             time BETWEEN ? AND ?
+            LIMIT 1
             '''
 
-        result = self._con.execute(sql, (jid,
+        result = self._con.execute(sql, (jid_id,
                                          resource,
                                          message_id,
                                          account_id,
@@ -1348,18 +1433,24 @@ class Logger:
         start_time = timestamp - 30
         end_time = timestamp + 30
 
+        try:
+            jid_id = self.get_jid_id(jid)
+        except ValueError:
+            # No messages were ever logged for this JID
+            return False
+
         account_id = self.get_account_id(account)
         log.debug('start: %s, end: %s, jid: %s, message: %s',
                   start_time, end_time, jid, msg)
 
         sql = '''
-            SELECT * FROM logs
-            NATURAL JOIN jids WHERE jid = ? AND message = ? AND account_id = ?
-            AND time BETWEEN ? AND ?
+            SELECT log_line_id FROM logs
+            WHERE jid_id = ? AND message = ? AND account_id = ?
+            AND time BETWEEN ? AND ? LIMIT 1
             '''
 
         result = self._con.execute(
-            sql, (jid, msg, account_id, start_time, end_time)).fetchone()
+            sql, (jid_id, msg, account_id, start_time, end_time)).fetchone()
 
         if result is not None:
             log.debug('Message already in DB')
@@ -1430,6 +1521,54 @@ class Logger:
             return True
         return False
 
+    @timeit
+    def find_stanza_ids(self, account, archive_jid, ids, groupchat=False):
+        """
+        Like find_stanza_id() but checks many ids with few queries
+
+        :param account:     The account
+
+        :param archive_jid: The jid of the archive the stanza-ids belong to
+                            only used if groupchat=True
+
+        :param ids:         A list of stanza-ids and origin-ids
+
+        :param groupchat:   stanza-ids are from a groupchat
+
+        return the set of ids which were found
+        """
+        found = set()
+        if not ids:
+            return found
+
+        type_ = JIDConstant.NORMAL_TYPE
+        if groupchat:
+            type_ = JIDConstant.ROOM_TYPE
+
+        archive_id = self.get_jid_id(archive_jid, type_=type_)
+        account_id = self.get_account_id(account)
+
+        # Stay well below SQLITE_MAX_VARIABLE_NUMBER
+        step = 500
+        for index in range(0, len(ids), step):
+            chunk = tuple(ids[index:index + step])
+            values = ', '.join('?' * len(chunk))
+            if groupchat:
+                sql = '''
+                    SELECT stanza_id FROM logs
+                    WHERE stanza_id IN ({values})
+                    AND +jid_id = ? AND account_id = ?
+                    '''.format(values=values)
+                params = chunk + (archive_id, account_id)
+            else:
+                sql = '''
+                    SELECT stanza_id FROM logs
+                    WHERE stanza_id IN ({values}) AND account_id = ? AND kind != ?
+                    '''.format(values=values)
+                params = chunk + (account_id, KindConstant.GC_MSG)
+            found.update(row.stanza_id for row in self._con.execute(sql, params))
+        return found
+
     def insert_jid(self, jid, kind=None, type_=JIDConstant.NORMAL_TYPE):
         """
         Insert a new jid into the `jids` table.
@@ -1443,6 +1582,22 @@ class Logger:
         """
         return self.get_jid_id(jid, kind, type_)
 
+    def _prepare_log_row(self, account, jid, kind, additional_data):
+        """
+        Resolve the ids and serialize the additional data of a new row
+        in the `logs` table
+
+        return a tuple (account_id, jid_id, additional_data), an empty
+        additional_data is returned as None
+        """
+        jid_id = self.get_jid_id(jid, kind=kind)
+        account_id = self.get_account_id(account)
+        if additional_data:
+            additional_data = _json_dumps(additional_data.data)
+        else:
+            additional_data = None
+        return account_id, jid_id, additional_data
+
     @timeit
     def insert_into_logs(self, account, jid, time_, kind,
                          unread=True, **kwargs):
@@ -1461,15 +1616,10 @@ class Logger:
         :param kwargs:  Every additional named argument must correspond to
                         a field in the `logs` table
         """
-        jid_id = self.get_jid_id(jid, kind=kind)
-        account_id = self.get_account_id(account)
-
-        if 'additional_data' in kwargs:
-            if not kwargs['additional_data']:
-                del kwargs['additional_data']
-            else:
-                serialized_dict = json.dumps(kwargs["additional_data"].data)
-                kwargs['additional_data'] = serialized_dict
+        account_id, jid_id, additional_data = self._prepare_log_row(
+            account, jid, kind, kwargs.pop('additional_data', None))
+        if additional_data is not None:
+            kwargs['additional_data'] = additional_data
 
         sql = '''
               INSERT INTO logs (account_id, jid_id, time, kind, {columns})
@@ -1485,13 +1635,46 @@ class Logger:
 
         if unread and kind == KindConstant.CHAT_MSG_RECV:
             sql = '''INSERT INTO unread_messages (message_id, jid_id)
-                     VALUES (?, (SELECT jid_id FROM jids WHERE jid = ?))'''
-            self._con.execute(sql, (lastrowid, jid))
+                     VALUES (?, ?)'''
+            self._con.execute(sql, (lastrowid, jid_id))
 
         self._timeout_commit()
 
         return lastrowid
 
+    @timeit
+    def insert_logs_bulk(self, account, rows):
+        """
+        Insert many messages into the `logs` table with one statement.
+        The messages are not added to the `unread_messages` table.
+
+        :param account: The account
+
+        :param rows:    A list of tuples (jid, time_, kind, message,
+                        contact_name, additional_data, stanza_id,
+                        message_id)
+        """
+        params = []
+        for (jid, time_, kind, message, contact_name,
+             additional_data, stanza_id, message_id) in rows:
+            account_id, jid_id, additional_data = self._prepare_log_row(
+                account, jid, kind, additional_data)
+            params.append((account_id, jid_id, time_, kind, message,
+                           contact_name, additional_data, stanza_id,
+                           message_id))
+
+        sql = '''
+              INSERT INTO logs (account_id, jid_id, time, kind, message,
+                                contact_name, additional_data, stanza_id,
+                                message_id)
+              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+              '''
+        self._con.executemany(sql, params)
+
+        log.info('Insert %s messages into DB', len(params))
+
+        self._timeout_commit()
+
     @timeit
     def set_message_error(self, account_jid, jid, message_id, error):
         """
@@ -1588,15 +1771,9 @@ class Logger:
 
         """
 
-        sql = '''INSERT INTO muc_avatars (jid, avatar_sha)
+        sql = '''REPLACE INTO muc_avatars (jid, avatar_sha)
                  VALUES (?, ?)'''
-
-        try:
-            self._con.execute(sql, (jid, sha))
-        except sqlite.IntegrityError:
-            sql = 'UPDATE muc_avatars SET avatar_sha = ? WHERE jid = ?'
-            self._con.execute(sql, (sha, jid))
-
+        self._con.execute(sql, (jid, sha))
         self._timeout_commit()
 
     @timeit
@@ -1645,9 +1822,21 @@ class Logger:
 
         """
         jid_id = self.get_jid_id(jid)
-        exists = self.get_archive_infos(jid)
-        if not exists:
-            sql = '''INSERT INTO last_archive_message
+
+        # Update only the given values of an existing row, if there is no
+        # row yet insert a new one
+        values = {key: value for key, value in kwargs.items()
+                  if value is not None}
+        updated = False
+        if values:
+            args = ' = ?, '.join(values.keys()) + ' = ?'
+            sql = '''UPDATE last_archive_message SET {}
+                     WHERE jid_id = ?'''.format(args)
+            cursor = self._con.execute(sql, tuple(values.values()) + (jid_id,))
+            updated = cursor.rowcount > 0
+
+        if not updated:
+            sql = '''INSERT OR IGNORE INTO last_archive_message
                      (jid_id, last_mam_id, oldest_mam_timestamp,
                       last_muc_timestamp, sync_threshold)
                       VALUES (?, ?, ?, ?, ?)'''
@@ -1658,15 +1847,6 @@ class Logger:
                 kwargs.get('last_muc_timestamp', None),
                 kwargs.get('sync_threshold', None)
             ))
-        else:
-            for key, value in list(kwargs.items()):
-                if value is None:
-                    del kwargs[key]
-
-            args = ' = ?, '.join(kwargs.keys()) + ' = ?'
-            sql = '''UPDATE last_archive_message SET {}
-                     WHERE jid_id = ?'''.format(args)
-            self._con.execute(sql, tuple(kwargs.values()) + (jid_id,))
         log.info('Set message archive info: %s %s', jid, kwargs)
         self._timeout_commit()
 
@@ -1718,20 +1898,10 @@ class Logger:
 
         log.info('Save disco info from %s', jid)
 
-        disco_exists = self.get_last_disco_info(jid) is not None
-        if disco_exists:
-            sql = '''UPDATE last_seen_disco_info SET
-                     disco_info = ?, last_seen = ?
-                     WHERE jid = ?'''
-
-            self._con.execute(sql, (disco_info, disco_info.timestamp, str(jid)))
-
-        else:
-            sql = '''INSERT INTO last_seen_disco_info
-                     (jid, disco_info, last_seen)
-                     VALUES (?, ?, ?)'''
-
-            self._con.execute(sql, (str(jid), disco_info, disco_info.timestamp))
+        sql = '''REPLACE INTO last_seen_disco_info
+                 (jid, disco_info, last_seen)
+                 VALUES (?, ?, ?)'''
+        self._con.execute(sql, (str(jid), disco_info, disco_info.timestamp))
 
         self._disco_info_cache[jid] = disco_info
         self._timeout_commit()
@@ -14,10 +14,13 @@
 
 # XEP-0048: Bookmarks
 
+import math
+import time
 from typing import Any
 from typing import List
 from typing import Dict
 from typing import Optional
+from typing import Tuple
 
 import nbxmpp
 from nbxmpp.util import is_error_result
@@ -30,6 +33,9 @@ from gajim.common.nec import NetworkEvent
 from gajim.common.modules.base import BaseModule
 from gajim.common.modules.util import event_node
 
+# Seconds a new bookmark waits before it is joined
+AUTOJOIN_DELAY = 10
+
 
 class Bookmarks(BaseModule):
 
@@ -46,8 +52,10 @@ class Bookmarks(BaseModule):
         self._register_pubsub_handler(self._bookmark_2_event_received)
         self._conversion = False
         self._conversion_2 = False
-        self._bookmarks = []
-        self._join_timeouts = []
+        self._pubsub_support = False
+        self._bookmarks = {}  # type: Dict[str, BookmarkData]
+        self._join_timeout_id = None  # type: Optional[int]
+        self._join_bookmarks = []  # type: List[Tuple[float, BookmarkData]]
         self._request_in_progress = True
 
     @property
@@ -60,19 +68,31 @@ class Bookmarks(BaseModule):
 
     @property
     def bookmarks(self):
-        return self._bookmarks
+        return list(self._bookmarks.values())
 
     @bookmarks.setter
     def bookmarks(self, value):
-        self._bookmarks = value
+        self._set_bookmarks(value)
+
+    def _set_bookmarks(self, bookmarks):
+        self._bookmarks = {str(bookmark.jid): bookmark
+                           for bookmark in bookmarks}
+
+    def _add_bookmark(self, bookmark):
+        # Modified bookmarks move to the end, like new ones
+        self._bookmarks.pop(str(bookmark.jid), None)
+        self._bookmarks[str(bookmark.jid)] = bookmark
+
+    def _remove_bookmark(self, jid):
+        self._bookmarks.pop(str(jid), None)
 
     @property
     def using_bookmark_1(self):
-        return self._pubsub_support() and self.conversion
+        return self._pubsub_support and self._conversion
 
     @property
     def using_bookmark_2(self):
-        return self._pubsub_support() and self.conversion_2
+        return self._pubsub_support and self._conversion_2
 
     @event_node(nbxmpp.NS_BOOKMARKS)
     def _bookmark_event_received(self, _con, _stanza, properties):
@@ -95,9 +115,14 @@ class Bookmarks(BaseModule):
         if bookmarks is None:
             bookmarks = []
 
-        old_bookmarks = self._convert_to_set(self._bookmarks)
-        self._bookmarks = bookmarks
-        self._act_on_changed_bookmarks(old_bookmarks)
+        if (len(bookmarks) != len(self._bookmarks) or
+                bookmarks != list(self._bookmarks.values())):
+            old_bookmarks = self._bookmarks
+            self._set_bookmarks(bookmarks)
+            self._act_on_changed_bookmarks(old_bookmarks)
+        else:
+            self._log.info('Bookmarks unchanged')
+
         app.nec.push_incoming_event(
             NetworkEvent('bookmarks-received', account=self._account))
 
@@ -115,34 +140,35 @@ class Bookmarks(BaseModule):
             self._log.info('Ignore update, pubsub request in progress')
             return
 
-        old_bookmarks = self._convert_to_set(self._bookmarks)
-
+        # Each event carries only one change, so there is no need to diff
+        # the whole bookmark list. Only new bookmarks or bookmarks where
+        # autojoin was enabled have to be acted on.
         if properties.pubsub_event.deleted or properties.pubsub_event.purged:
             self._log.info('Bookmark node deleted/purged')
-            self._bookmarks = []
+            self._set_bookmarks([])
 
         elif properties.pubsub_event.retracted:
             jid = properties.pubsub_event.id
             self._log.info('Retract: %s', jid)
-            bookmark = self.get_bookmark_from_jid(jid)
-            if bookmark is not None:
-                try:
-                    self._bookmarks.remove(bookmark)
-                except KeyError:
-                    pass
+            self._remove_bookmark(jid)
 
         else:
             new_bookmark = properties.pubsub_event.data
             old_bookmark = self.get_bookmark_from_jid(new_bookmark.jid)
-            if old_bookmark is not None:
-                self._bookmarks.remove(old_bookmark)
-            self._bookmarks.append(new_bookmark)
+            self._add_bookmark(new_bookmark)
+            if new_bookmark.autojoin and (old_bookmark is None or
+                                          not old_bookmark.autojoin):
+                self._schedule_autojoin([new_bookmark])
 
-        self._act_on_changed_bookmarks(old_bookmarks)
         app.nec.push_incoming_event(
             NetworkEvent('bookmarks-received', account=self._account))
 
     def pass_disco(self, info):
+        # PEP and PubSub got the disco info before us
+        self._pubsub_support = bool(
+            self._con.get_module('PEP').supported and
+            self._con.get_module('PubSub').publish_options)
+
         if app.config.get('dev_force_bookmark_2'):
             self._log.info('Forcing Bookmark 2 usage, '
                            'without server conversion support: %s', info.jid)
@@ -157,42 +183,38 @@ class Bookmarks(BaseModule):
             self._log.info('Discovered Bookmarks Conversion: %s', info.jid)
 
     def _act_on_changed_bookmarks(self, old_bookmarks):
-        new_bookmarks = self._convert_to_set(self._bookmarks)
-        changed = new_bookmarks - old_bookmarks
-        if not changed:
-            return
-
-        join = [jid for jid, autojoin in changed if autojoin]
-        bookmarks = []
-        for jid in join:
-            self._log.info('Schedule autojoin in 10s for: %s', jid)
-            bookmarks.append(self.get_bookmark_from_jid(jid))
-        # If another client creates a MUC, the MUC is locked until the
-        # configuration is finished. Give the user some time to finish
-        # the configuration.
-        timeout_id = GLib.timeout_add_seconds(
-            10, self._join_with_timeout, bookmarks)
-        self._join_timeouts.append(timeout_id)
+        # Join bookmarks which are new or where autojoin was enabled
+        join = []
+        for jid, bookmark in self._bookmarks.items():
+            if not bookmark.autojoin:
+                continue
+            old_bookmark = old_bookmarks.get(jid)
+            if old_bookmark is None or not old_bookmark.autojoin:
+                join.append(bookmark)
+        self._schedule_autojoin(join)
 
         # TODO: leave mucs
-        # leave = [jid for jid, autojoin in changed if not autojoin]
 
-    @staticmethod
-    def _convert_to_set(bookmarks):
-        set_ = set()
+    def _schedule_autojoin(self, bookmarks):
+        if not bookmarks:
+            return
+
+        now = time.monotonic()
         for bookmark in bookmarks:
-            set_.add((bookmark.jid, bookmark.autojoin))
-        return set_
+            self._log.info('Schedule autojoin in %ss for: %s',
+                           AUTOJOIN_DELAY, bookmark.jid)
+            self._join_bookmarks.append((now, bookmark))
 
-    def get_bookmark_from_jid(self, jid):
-        for bookmark in self._bookmarks:
-            if bookmark.jid == jid:
-                return bookmark
-        return None
+        # If another client creates a MUC, the MUC is locked until the
+        # configuration is finished. Give the user some time to finish
+        # the configuration. One timeout is shared by all pending
+        # bookmarks, it is only started if none is running.
+        if self._join_timeout_id is None:
+            self._join_timeout_id = GLib.timeout_add_seconds(
+                AUTOJOIN_DELAY, self._join_with_timeout)
 
-    def _pubsub_support(self) -> bool:
-        return (self._con.get_module('PEP').supported and
-                self._con.get_module('PubSub').publish_options)
+    def get_bookmark_from_jid(self, jid):
+        return self._bookmarks.get(str(jid))
 
     def request_bookmarks(self):
         if not app.account_is_connected(self._account):
@@ -200,7 +222,7 @@ class Bookmarks(BaseModule):
 
         self._request_in_progress = True
         type_ = BookmarkStoreType.PRIVATE
-        if self._pubsub_support():
+        if self._pubsub_support:
             if self.conversion:
                 type_ = BookmarkStoreType.PUBSUB_BOOKMARK_1
             if self._conversion_2:
@@ -215,7 +237,7 @@ class Bookmarks(BaseModule):
             bookmarks = []
 
         self._request_in_progress = False
-        self._bookmarks = bookmarks
+        self._set_bookmarks(bookmarks)
         self.auto_join_bookmarks()
         app.nec.push_incoming_event(
             NetworkEvent('bookmarks-received', account=self._account))
@@ -230,10 +252,10 @@ class Bookmarks(BaseModule):
 
             if add_or_modify:
                 self.store_bookmarks(add_or_modify)
-            self._bookmarks = bookmarks
+            self._set_bookmarks(bookmarks)
 
         else:
-            self._bookmarks = bookmarks
+            self._set_bookmarks(bookmarks)
             self.store_bookmarks()
 
     def store_bookmarks(self, bookmarks=None):
@@ -241,13 +263,13 @@ class Bookmarks(BaseModule):
             return
 
         type_ = BookmarkStoreType.PRIVATE
-        if self._pubsub_support():
+        if self._pubsub_support:
             if self.conversion:
                 type_ = BookmarkStoreType.PUBSUB_BOOKMARK_1
             if self.conversion_2:
                 type_ = BookmarkStoreType.PUBSUB_BOOKMARK_2
 
-        self._nbxmpp('Bookmarks').store_bookmarks(bookmarks or self._bookmarks,
+        self._nbxmpp('Bookmarks').store_bookmarks(bookmarks or self.bookmarks,
                                                   type_)
 
         app.nec.push_incoming_event(
@@ -266,9 +288,27 @@ class Bookmarks(BaseModule):
         app.nec.push_incoming_event(
             NetworkEvent('bookmarks-received', account=self._account))
 
-    def _join_with_timeout(self, bookmarks: List[Any]) -> None:
-        self._join_timeouts.pop(0)
-        self.auto_join_bookmarks(bookmarks)
+    def _join_with_timeout(self) -> None:
+        self._join_timeout_id = None
+        now = time.monotonic()
+        bookmarks = []
+        pending = []
+        for scheduled, bookmark in self._join_bookmarks:
+            if now - scheduled >= AUTOJOIN_DELAY:
+                bookmarks.append(bookmark)
+            else:
+                pending.append((scheduled, bookmark))
+        self._join_bookmarks = pending
+
+        # Bookmarks which arrived while the timeout was running still
+        # get their full delay, wait until the oldest of them is due
+        if pending:
+            remaining = AUTOJOIN_DELAY - (now - pending[0][0])
+            self._join_timeout_id = GLib.timeout_add_seconds(
+                max(1, math.ceil(remaining)), self._join_with_timeout)
+
+        if bookmarks:
+            self.auto_join_bookmarks(bookmarks)
 
     def auto_join_bookmarks(self,
                             bookmarks: Optional[List[Any]] = None) -> None:
@@ -276,20 +316,21 @@ class Bookmarks(BaseModule):
             return
 
         if bookmarks is None:
-            bookmarks = self._bookmarks
-
-        for bookmark in bookmarks:
-            if bookmark.autojoin:
-                # Only join non-opened groupchats. Opened one are already
-                # auto-joined on re-connection
-                if bookmark.jid not in app.gc_connected[self._account]:
-                    # we are not already connected
-                    self._log.info('Autojoin Bookmark: %s', bookmark.jid)
-                    minimize = app.config.get_per('rooms', bookmark.jid,
-                                                  'minimize_on_autojoin', True)
-                    app.interface.join_groupchat(self._account,
-                                                 str(bookmark.jid),
-                                                 minimized=minimize)
+            bookmarks = self.bookmarks
+
+        # Only join non-opened groupchats. Opened one are already
+        # auto-joined on re-connection
+        connected = app.gc_connected[self._account]
+        join = [bookmark for bookmark in bookmarks
+                if bookmark.autojoin and bookmark.jid not in connected]
+
+        get_per = app.config.get_per
+        join_groupchat = app.interface.join_groupchat
+        for bookmark in join:
+            self._log.info('Autojoin Bookmark: %s', bookmark.jid)
+            minimize = get_per('rooms', bookmark.jid,
+                               'minimize_on_autojoin', True)
+            join_groupchat(self._account, str(bookmark.jid), minimized=minimize)
 
     def modify(self, jid: str, **kwargs: Dict[str, str]) -> None:
         bookmark = self.get_bookmark_from_jid(jid)
@@ -301,8 +342,7 @@ class Bookmarks(BaseModule):
             # No change happened
             return
         self._log.info('Modify bookmark: %s %s', jid, kwargs)
-        self._bookmarks.remove(bookmark)
-        self._bookmarks.append(new_bookmark)
+        self._add_bookmark(new_bookmark)
 
         if self.using_bookmark_2:
             self.store_bookmark(new_bookmark)
@@ -316,7 +356,7 @@ class Bookmarks(BaseModule):
             return
 
         new_bookmark = BookmarkData(jid=jid, **kwargs)
-        self._bookmarks.append(new_bookmark)
+        self._add_bookmark(new_bookmark)
         self._log.info('Add new bookmark: %s', new_bookmark)
 
         if self.using_bookmark_2:
@@ -328,7 +368,7 @@ class Bookmarks(BaseModule):
         bookmark = self.get_bookmark_from_jid(jid)
         if bookmark is None:
             return
-        self._bookmarks.remove(bookmark)
+        self._remove_bookmark(jid)
         if publish:
             if self.using_bookmark_2:
                 self._nbxmpp('Bookmarks').retract_bookmark(jid)
@@ -336,20 +376,16 @@ class Bookmarks(BaseModule):
                 self.store_bookmarks()
 
     @staticmethod
-    def _determine_changed_bookmarks(new_bookmarks, old_bookmarks):
-        new_jids = [bookmark.jid for bookmark in new_bookmarks]
-        new_bookmarks = set(new_bookmarks)
-        old_bookmarks = set(old_bookmarks)
-
-        retract = []
-        add_or_modify = []
-        changed_bookmarks = new_bookmarks.symmetric_difference(old_bookmarks)
-
-        for bookmark in changed_bookmarks:
-            if bookmark.jid not in new_jids:
-                retract.append(bookmark)
-            if bookmark in new_bookmarks:
-                add_or_modify.append(bookmark)
+    def _determine_changed_bookmarks(new_bookmarks, old_by_jid):
+        # old_by_jid is the bookmark store itself, it is already keyed
+        # by JID
+        new_by_jid = {str(bookmark.jid): bookmark
+                      for bookmark in new_bookmarks}
+
+        retract = [bookmark for jid, bookmark in old_by_jid.items()
+                   if jid not in new_by_jid]
+        add_or_modify = [bookmark for jid, bookmark in new_by_jid.items()
+                         if old_by_jid.get(jid) != bookmark]
         return retract, add_or_modify
 
     def get_name_from_bookmark(self, jid: str) -> str:
@@ -359,7 +395,7 @@ class Bookmarks(BaseModule):
         return bookmark.name
 
     def is_bookmark(self, jid: str) -> bool:
-        return self.get_bookmark_from_jid(jid) is not None
+        return str(jid) in self._bookmarks
 
     def purge_pubsub_bookmarks(self) -> None:
         self._log.info('Purge/Delete Bookmarks on PubSub, '
@@ -368,8 +404,10 @@ class Bookmarks(BaseModule):
         self._con.get_module('PubSub').send_pb_delete('', 'storage:bookmarks')
 
     def _remove_timeouts(self):
-        for _id in self._join_timeouts:
-            GLib.source_remove(_id)
+        if self._join_timeout_id is not None:
+            GLib.source_remove(self._join_timeout_id)
+            self._join_timeout_id = None
+        self._join_bookmarks = []
 
     def cleanup(self):
         self._remove_timeouts()
@@ -41,17 +41,20 @@ class Gateway(BaseModule):
             return
 
         agent = stanza.getFrom().getBare()
-        jid_list = []
-        for jid in app.contacts.get_jid_list(self._account):
-            if jid.endswith('@' + agent):
-                jid_list.append(jid)
-                self._log.info('Removing contact %s due to'
-                               ' unregistered transport %s', jid, agent)
-                self._con.get_module('Presence').unsubscribe(jid)
-                # Transport contacts can't have 2 resources
-                if jid in app.to_be_removed[self._account]:
-                    # This way we'll really remove it
-                    app.to_be_removed[self._account].remove(jid)
+        suffix = '@' + agent
+        jid_list = [jid for jid in app.contacts.get_jid_list(self._account)
+                    if jid.endswith(suffix)]
+
+        unsubscribe = self._con.get_module('Presence').unsubscribe
+        to_be_removed = app.to_be_removed[self._account]
+        for jid in jid_list:
+            self._log.info('Removing contact %s due to'
+                           ' unregistered transport %s', jid, agent)
+            unsubscribe(jid)
+            # Transport contacts can't have 2 resources
+            if jid in to_be_removed:
+                # This way we'll really remove it
+                to_be_removed.remove(jid)
 
         app.nec.push_incoming_event(
             NetworkEvent('agent-removed',
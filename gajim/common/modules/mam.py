@@ -19,6 +19,7 @@ from datetime import datetime, timedelta
 
 import nbxmpp
 from nbxmpp.structs import StanzaHandler
+from gi.repository import GLib
 
 from gajim.common import app
 from gajim.common.nec import NetworkEvent
@@ -51,8 +52,21 @@ class MAM(BaseModule):
         self.archiving_namespace = None
         self._mam_query_ids = {}
 
+        # Archived messages of a page, keyed by query id. They are written
+        # to the database together when the page is finished.
+        self._mam_batch = {}
+
         # Holds archive jids where catch up was successful
-        self._catch_up_finished = []
+        self._catch_up_finished = set()
+
+        # Bare JID of our own archive, set on first use after connect
+        self._own_bare_jid = None
+
+        # Last stanza-id and timestamp per archive jid, seen on live
+        # messages. Only the newest one matters, so they are written
+        # together after a short delay.
+        self._pending_archive_infos = {}
+        self._archive_infos_timeout_id = None
 
     def pass_disco(self, info):
         if nbxmpp.NS_MAM_2 in info.features:
@@ -72,8 +86,38 @@ class MAM(BaseModule):
                          feature=self.archiving_namespace))
 
     def reset_state(self):
+        for query_id in list(self._mam_batch):
+            self._flush_mam_batch(query_id)
+        self._write_archive_infos()
         self._mam_query_ids.clear()
         self._catch_up_finished.clear()
+        # Our JID can change on connect, e.g. with anonymous auth
+        self._own_bare_jid = None
+
+    def _get_own_bare_jid(self):
+        if self._own_bare_jid is None:
+            self._own_bare_jid = self._con.get_own_jid().getBare()
+        return self._own_bare_jid
+
+    def cleanup(self):
+        BaseModule.cleanup(self)
+        self._write_archive_infos()
+
+    def _write_archive_infos(self):
+        if self._archive_infos_timeout_id is not None:
+            GLib.source_remove(self._archive_infos_timeout_id)
+            self._archive_infos_timeout_id = None
+
+        for jid, (mam_id, timestamp) in self._pending_archive_infos.items():
+            app.logger.set_archive_infos(jid,
+                                         last_mam_id=mam_id,
+                                         last_muc_timestamp=timestamp)
+        self._pending_archive_infos.clear()
+
+    def _on_archive_infos_timeout(self):
+        self._archive_infos_timeout_id = None
+        self._write_archive_infos()
+        return False
 
     def is_catch_up_finished(self, jid):
         return jid in self._catch_up_finished
@@ -127,7 +171,10 @@ class MAM(BaseModule):
                 return
 
         else:
-            archive_jid = self._con.get_own_jid().getBare()
+            if properties.stanza_id is None:
+                # Most 1:1 stanzas like chat states and receipts
+                return
+            archive_jid = self._get_own_bare_jid()
             namespace = self.archiving_namespace
             timestamp = None
 
@@ -140,9 +187,11 @@ class MAM(BaseModule):
         if not self.is_catch_up_finished(archive_jid):
             return
 
-        app.logger.set_archive_infos(archive_jid,
-                                     last_mam_id=properties.stanza_id.id,
-                                     last_muc_timestamp=timestamp)
+        self._pending_archive_infos[archive_jid] = (properties.stanza_id.id,
+                                                    timestamp)
+        if self._archive_infos_timeout_id is None:
+            self._archive_infos_timeout_id = GLib.timeout_add_seconds(
+                2, self._on_archive_infos_timeout)
 
     def _mam_message_received(self, _con, stanza, properties):
         if not properties.is_mam_message:
@@ -159,9 +208,9 @@ class MAM(BaseModule):
                               properties.mam.archive)
             raise nbxmpp.NodeProcessed
 
-        self._log.info('Received message from archive: %s',
-                       properties.mam.archive)
-        if not self._is_valid_request(properties):
+        archive_jid = str(properties.mam.archive)
+        self._log.info('Received message from archive: %s', archive_jid)
+        if not self._is_valid_request(properties, archive_jid):
             self._log.warning('Invalid MAM Message: unknown query id %s',
                               properties.mam.query_id)
             self._log.debug(stanza)
@@ -177,17 +226,8 @@ class MAM(BaseModule):
                 kind = KindConstant.CHAT_MSG_RECV
 
         stanza_id, message_id = self._get_unique_id(properties)
-
-        if properties.mam.is_ver_2:
-            # Search only with stanza-id for duplicates on mam:2
-            if app.logger.find_stanza_id(self._account,
-                                         str(properties.mam.archive),
-                                         stanza_id,
-                                         message_id,
-                                         groupchat=is_groupchat):
-                self._log.info('Found duplicate with stanza-id: %s, '
-                               'message-id: %s', stanza_id, message_id)
-                raise nbxmpp.NodeProcessed
+        # The ids we search for duplicates on mam:2
+        unique_ids = (stanza_id, message_id)
 
         additional_data = AdditionalDataDict()
         if properties.has_user_delay:
@@ -222,37 +262,86 @@ class MAM(BaseModule):
                 return
             stanza_id = message_id
 
-        if properties.mam.namespace == nbxmpp.NS_MAM_1:
-            if app.logger.search_for_duplicate(
-                    self._account, with_, properties.mam.timestamp, msgtxt):
-                self._log.info('Found duplicate with fallback for mam:1')
-                return
+        self._mam_batch.setdefault(properties.mam.query_id, []).append(
+            (properties, kind, with_, msgtxt,
+             additional_data, stanza_id, unique_ids))
 
-        app.logger.insert_into_logs(self._account,
-                                    with_,
-                                    properties.mam.timestamp,
-                                    kind,
-                                    unread=False,
-                                    message=msgtxt,
-                                    contact_name=properties.muc_nickname,
-                                    additional_data=additional_data,
-                                    stanza_id=stanza_id,
-                                    message_id=properties.id)
+    def _flush_mam_batch(self, query_id):
+        batch = self._mam_batch.pop(query_id, None)
+        if not batch:
+            return
 
-        app.nec.push_incoming_event(
-            NetworkEvent('mam-decrypted-message-received',
-                         account=self._account,
-                         additional_data=additional_data,
-                         correct_id=parse_correction(properties),
-                         archive_jid=properties.mam.archive,
-                         msgtxt=properties.body,
-                         properties=properties,
-                         kind=kind,
-                         )
-        )
-
-    def _is_valid_request(self, properties):
-        valid_id = self._mam_query_ids.get(str(properties.mam.archive), None)
+        properties = batch[0][0]
+        is_ver_2 = properties.mam.is_ver_2
+        found = set()
+        if is_ver_2:
+            # Search only with stanza-id for duplicates on mam:2
+            ids = [id_ for entry in batch for id_ in entry[6]
+                   if id_ is not None]
+            found = app.logger.find_stanza_ids(
+                self._account,
+                str(properties.mam.archive),
+                ids,
+                groupchat=properties.type.is_groupchat)
+
+        # Timestamps of the rows accepted so far, by (with_, msgtxt). The
+        # mam:1 fallback only searches the database, which does not
+        # contain this page yet.
+        accepted = {}
+        rows = []
+        inserted = []
+        for entry in batch:
+            (properties, kind, with_, msgtxt,
+             additional_data, stanza_id, unique_ids) = entry
+            if found.intersection(unique_ids):
+                self._log.info('Found duplicate with stanza-id: %s, '
+                               'message-id: %s', *unique_ids)
+                continue
+
+            timestamp = properties.mam.timestamp
+            if properties.mam.namespace == nbxmpp.NS_MAM_1:
+                # Same window as Logger.search_for_duplicate()
+                previous = accepted.get((with_, msgtxt), ())
+                if (any(abs(timestamp - time_) <= 30 for time_ in previous) or
+                        app.logger.search_for_duplicate(
+                            self._account, with_, timestamp, msgtxt)):
+                    self._log.info('Found duplicate with fallback for mam:1')
+                    continue
+                accepted.setdefault((with_, msgtxt), []).append(timestamp)
+
+            rows.append((with_,
+                         timestamp,
+                         kind,
+                         msgtxt,
+                         properties.muc_nickname,
+                         additional_data,
+                         stanza_id,
+                         properties.id))
+            inserted.append(entry)
+            if is_ver_2 and stanza_id is not None:
+                # Later messages of the same page have to see this one
+                found.add(stanza_id)
+
+        if not rows:
+            return
+
+        app.logger.insert_logs_bulk(self._account, rows)
+
+        for properties, kind, _, _, additional_data, _, _ in inserted:
+            app.nec.push_incoming_event(
+                NetworkEvent('mam-decrypted-message-received',
+                             account=self._account,
+                             additional_data=additional_data,
+                             correct_id=parse_correction(properties),
+                             archive_jid=properties.mam.archive,
+                             msgtxt=properties.body,
+                             properties=properties,
+                             kind=kind,
+                             )
+            )
+
+    def _is_valid_request(self, properties, archive_jid):
+        valid_id = self._mam_query_ids.get(archive_jid, None)
         return valid_id == properties.mam.query_id
 
     def _get_query_id(self, jid):
@@ -282,13 +371,13 @@ class MAM(BaseModule):
         jid = stanza.getFrom()
         if jid is None:
             # No from means, iq from our own archive
-            jid = self._con.get_own_jid().getStripped()
+            jid = self._get_own_bare_jid()
         else:
             jid = jid.getStripped()
         return jid
 
     def request_archive_count(self, start_date, end_date):
-        jid = self._con.get_own_jid().getStripped()
+        jid = self._get_own_bare_jid()
         self._log.info('Request archive count from: %s', jid)
         query_id = self._get_query_id(jid)
         query = self._get_archive_query(
@@ -298,6 +387,7 @@ class MAM(BaseModule):
         return query_id
 
     def _received_count(self, _con, stanza, query_id):
+        self._flush_mam_batch(query_id)
         try:
             _, set_ = self._parse_iq(stanza)
         except InvalidMamIQ:
@@ -312,12 +402,13 @@ class MAM(BaseModule):
             None, query_id=query_id, count=count))
 
     def request_archive_on_signin(self):
-        own_jid = self._con.get_own_jid().getStripped()
+        own_jid = self._get_own_bare_jid()
 
         if own_jid in self._mam_query_ids:
             self._log.warning('MAM request for %s already running', own_jid)
             return
 
+        self._write_archive_infos()
         archive = app.logger.get_archive_infos(own_jid)
 
         # Migration of last_mam_id from config to DB
@@ -340,11 +431,11 @@ class MAM(BaseModule):
             self._log.info('First start: query archive start: %s', start_date)
             query = self._get_archive_query(query_id, start=start_date)
 
-        if own_jid in self._catch_up_finished:
-            self._catch_up_finished.remove(own_jid)
+        self._catch_up_finished.discard(own_jid)
         self._send_archive_query(query, query_id, start_date)
 
     def request_archive_on_muc_join(self, jid):
+        self._write_archive_infos()
         archive = app.logger.get_archive_infos(jid)
         threshold = get_sync_threshold(jid, archive)
         self._log.info('Threshold for %s: %s', jid, threshold)
@@ -375,8 +466,8 @@ class MAM(BaseModule):
                 self._log.info('No last muc timestamp found ( mam:1? )')
                 last_timestamp = 0
 
-            last = datetime.utcfromtimestamp(float(last_timestamp))
-            if datetime.utcnow() - last > timedelta(days=threshold):
+            elapsed = time.time() - float(last_timestamp)
+            if elapsed > threshold * 86400:
                 # To much time has elapsed since last join, apply threshold
                 start_date = datetime.utcnow() - timedelta(days=threshold)
                 self._log.info('Too much time elapsed since last join, '
@@ -391,8 +482,7 @@ class MAM(BaseModule):
                 query = self._get_archive_query(
                     query_id, jid=jid, after=archive.last_mam_id)
 
-        if jid in self._catch_up_finished:
-            self._catch_up_finished.remove(jid)
+        self._catch_up_finished.discard(jid)
         self._send_archive_query(query, query_id, start_date, groupchat=True)
 
     def _send_archive_query(self, query, query_id, start_date=None,
@@ -403,6 +493,7 @@ class MAM(BaseModule):
                                            'groupchat': groupchat})
 
     def _result_finished(self, _con, stanza, query_id, start_date, groupchat):
+        self._flush_mam_batch(query_id)
         try:
             fin, set_ = self._parse_iq(stanza)
         except InvalidMamIQ:
@@ -413,7 +504,7 @@ class MAM(BaseModule):
         last = set_.getTagData('last')
         if last is None:
             self._log.info('End of MAM query, no items retrieved')
-            self._catch_up_finished.append(jid)
+            self._catch_up_finished.add(jid)
             self._mam_query_ids.pop(jid)
             return
 
@@ -435,12 +526,12 @@ class MAM(BaseModule):
                 app.logger.set_archive_infos(
                     jid, oldest_mam_timestamp=start_date.timestamp())
 
-            self._catch_up_finished.append(jid)
+            self._catch_up_finished.add(jid)
             self._log.info('End of MAM query, last mam id: %s', last)
 
     def request_archive_interval(self, start_date, end_date, after=None,
                                  query_id=None):
-        jid = self._con.get_own_jid().getStripped()
+        jid = self._get_own_bare_jid()
         if after is None:
             self._log.info('Request intervall from %s to %s from %s',
                            start_date, end_date, jid)
@@ -460,6 +551,7 @@ class MAM(BaseModule):
 
     def _intervall_result(self, _con, stanza, query_id,
                           start_date, end_date):
+        self._flush_mam_batch(query_id)
         try:
             fin, set_ = self._parse_iq(stanza)
         except InvalidMamIQ:
@@ -493,13 +585,12 @@ class MAM(BaseModule):
 
     def _get_archive_query(self, query_id, jid=None, start=None, end=None,
                            with_=None, after=None, max_=70):
-        # Muc archive query?
-        disco_info = app.logger.get_last_disco_info(jid)
-        if disco_info is None:
-            # Query to our own archive
-            namespace = self.archiving_namespace
-        else:
-            namespace = disco_info.mam_namespace
+        namespace = self.archiving_namespace
+        if jid is not None:
+            # Muc archive query?
+            disco_info = app.logger.get_last_disco_info(jid)
+            if disco_info is not None:
+                namespace = disco_info.mam_namespace
 
         iq = nbxmpp.Iq('set', to=jid)
         query = iq.addChild('query', namespace=namespace)
@@ -512,12 +603,12 @@ class MAM(BaseModule):
             field = nbxmpp.DataField(
                 typ='text-single',
                 name='start',
-                value=start.strftime('%Y-%m-%dT%H:%M:%SZ'))
+                value=_format_date(start))
             form.addChild(node=field)
         if end:
             field = nbxmpp.DataField(typ='text-single',
                                      name='end',
-                                     value=end.strftime('%Y-%m-%dT%H:%M:%SZ'))
+                                     value=_format_date(end))
             form.addChild(node=field)
         if with_:
             field = nbxmpp.DataField(typ='jid-single',
@@ -591,6 +682,12 @@ class MAM(BaseModule):
                 MAMPreferenceSaved(None, conn=self._con))
 
 
+def _format_date(date):
+    # Same result as strftime('%Y-%m-%dT%H:%M:%SZ') for the naive UTC
+    # datetimes we use, without parsing a format string every page
+    return date.replace(microsecond=0).isoformat() + 'Z'
+
+
 class MAMPreferenceError(NetworkIncomingEvent):
     name = 'mam-prefs-error'
 
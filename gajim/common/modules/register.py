@@ -50,12 +50,14 @@ class Register(BaseModule):
         if not nbxmpp.isResultNode(stanza):
             error = stanza.getErrorMsg()
             self._log.info('Error: %s', error)
-            if error_cb() is not None:
-                error_cb()(error)
+            error_cb = error_cb()
+            if error_cb is not None:
+                error_cb(error)
         else:
             self._log.info('Password changed')
-            if success_cb() is not None:
-                success_cb()()
+            success_cb = success_cb()
+            if success_cb is not None:
+                success_cb()
 
     def register_agent(self, agent, form, is_form, success_cb, error_cb):
         if not app.account_is_connected(self._account):
@@ -86,11 +88,12 @@ class Register(BaseModule):
         if not nbxmpp.isResultNode(stanza):
             error = stanza.getErrorMsg()
             self._log.info('Error: %s', error)
-            if error_cb() is not None:
+            error_cb = error_cb()
+            if error_cb is not None:
                 form = is_form = None
                 if stanza.getErrorType() == 'modify':
                     form, is_form = self._get_register_form(stanza)
-                error_cb()(error, form, is_form)
+                error_cb(error, form, is_form)
             return
 
         self._con.get_module('Presence').subscribe(agent, auto_auth=True)
@@ -99,8 +102,9 @@ class Register(BaseModule):
         if self.agent_registrations[agent]['sub_received']:
             self._con.get_module('Presence').subscribed(agent)
 
-        if success_cb() is not None:
-            success_cb()()
+        success_cb = success_cb()
+        if success_cb is not None:
+            success_cb()
 
     def get_register_form(self, jid, success_cb, error_cb):
         if not app.account_is_connected(self._account):
@@ -118,14 +122,16 @@ class Register(BaseModule):
         if not nbxmpp.isResultNode(stanza):
             error = stanza.getErrorMsg()
             self._log.info('Error: %s', error)
-            if error_cb() is not None:
-                error_cb()(error)
+            error_cb = error_cb()
+            if error_cb is not None:
+                error_cb(error)
         else:
             self._log.info('Register form received')
 
-            if success_cb() is not None:
+            success_cb = success_cb()
+            if success_cb is not None:
                 form, is_form = self._get_register_form(stanza)
-                success_cb()(form, is_form)
+                success_cb(form, is_form)
 
     @staticmethod
     def _get_register_form(stanza):
@@ -137,12 +143,10 @@ class Register(BaseModule):
             oob = stanza.getQuery().getTag('x', namespace=nbxmpp.NS_X_OOB)
             if oob is not None:
                 form['redirect-url'] = oob.getTagData('url')
-            for field in stanza.getQueryPayload():
-                if not isinstance(field, nbxmpp.Node):
-                    continue
-                if field.getName() == 'x':
-                    continue
-                form[field.getName()] = field.getData()
+            form.update((field.getName(), field.getData())
+                        for field in stanza.getQueryPayload()
+                        if isinstance(field, nbxmpp.Node) and
+                        field.getName() != 'x')
 
         return form, is_form
 
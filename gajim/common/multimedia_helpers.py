@@ -15,10 +15,14 @@
 # along with Gajim. If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from typing import ClassVar  # pylint: disable=unused-import
+from typing import Dict  # pylint: disable=unused-import
+from typing import Optional  # pylint: disable=unused-import
 
 import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst  # pylint: disable=wrong-import-position
+from gi.repository import GLib  # pylint: disable=wrong-import-position
 
 from gajim.common.i18n import _  # pylint: disable=wrong-import-position
 
@@ -26,6 +30,16 @@ log = logging.getLogger('gajim.c.multimedia_helpers')
 
 
 class DeviceManager:
+    # Key of the detected devices in the cache shared by all instances
+    CACHE_KEY = None  # type: ClassVar[Optional[str]]
+
+    # Probing the elements opens every device, so the result is kept
+    # until the device monitor reports an added or removed device.
+    # The monitor runs from the first detection until stop_monitor().
+    _cache = {}  # type: ClassVar[Dict[str, Dict[str, str]]]
+    _monitor = None  # type: ClassVar[Optional[Gst.DeviceMonitor]]
+    _monitor_failed = False  # type: ClassVar[bool]
+
     def __init__(self):
         self.devices = {}
 
@@ -33,10 +47,65 @@ class DeviceManager:
         self.devices = {}
 
     def get_devices(self):
-        if not self.devices:
-            self.detect()
+        if self.devices:
+            return self.devices
+
+        devices = self._cache.get(self.CACHE_KEY)
+        if devices is not None:
+            self.devices = dict(devices)
+            return self.devices
+
+        self.detect()
+        if self.CACHE_KEY is not None and self._start_monitor():
+            DeviceManager._cache[self.CACHE_KEY] = dict(self.devices)
         return self.devices
 
+    @classmethod
+    def _start_monitor(cls):
+        if cls._monitor is not None:
+            return True
+
+        if cls._monitor_failed:
+            return False
+
+        monitor = Gst.DeviceMonitor.new()
+        monitor.add_filter('Audio/Source', None)
+        monitor.add_filter('Audio/Sink', None)
+        monitor.add_filter('Video/Source', None)
+        if not monitor.start():
+            # Without change notifications we can't cache
+            log.info('Could not start device monitor')
+            DeviceManager._monitor_failed = True
+            return False
+
+        # Providers may announce the devices which are already present
+        # while starting, these must not clear the cache
+        bus = monitor.get_bus()
+        while bus.pop() is not None:
+            pass
+        bus.add_watch(GLib.PRIORITY_DEFAULT, cls._on_device_message)
+        DeviceManager._monitor = monitor
+        return True
+
+    @classmethod
+    def stop_monitor(cls):
+        if cls._monitor is None:
+            return
+
+        cls._monitor.get_bus().remove_watch()
+        cls._monitor.stop()
+        DeviceManager._monitor = None
+        # Changes are not noticed anymore
+        DeviceManager._cache.clear()
+
+    @staticmethod
+    def _on_device_message(_bus, message):
+        if message.type in (Gst.MessageType.DEVICE_ADDED,
+                            Gst.MessageType.DEVICE_REMOVED):
+            log.info('Devices changed, clear device cache')
+            DeviceManager._cache.clear()
+        return True
+
     def detect_element(self, name, text, pipe='%s'):
         if Gst.ElementFactory.find(name):
             element = Gst.ElementFactory.make(name, '%spresencetest' % name)
@@ -65,6 +134,8 @@ class DeviceManager:
 
 
 class AudioInputManager(DeviceManager):
+    CACHE_KEY = 'audio_in'
+
     def detect(self):
         self.devices = {}
         # Test src
@@ -82,6 +153,8 @@ class AudioInputManager(DeviceManager):
 
 
 class AudioOutputManager(DeviceManager):
+    CACHE_KEY = 'audio_out'
+
     def detect(self):
         self.devices = {}
         # Fake sink
@@ -95,6 +168,8 @@ class AudioOutputManager(DeviceManager):
 
 
 class VideoInputManager(DeviceManager):
+    CACHE_KEY = 'video_in'
+
     def detect(self):
         self.devices = {}
         # Test src
@@ -1803,6 +1803,7 @@ class RosterWindow:
         old unread messages, delete them from unread table
         """
         results = app.logger.get_unread_msgs()
+        old_msg_log_ids = []
         for result, shown in results:
             jid = result.jid
             additional_data = result.additional_data
@@ -1823,7 +1824,10 @@ class RosterWindow:
                 # table that is older than a month. It is probably from someone
                 # not in our roster for accounts we usually launch, so we will
                 # delete this id from unread message tables.
-                app.logger.set_read_messages([result.log_line_id])
+                old_msg_log_ids.append(result.log_line_id)
+
+        if old_msg_log_ids:
+            app.logger.set_read_messages(old_msg_log_ids)
 
     def fill_contacts_and_groups_dicts(self, array, account):
         """
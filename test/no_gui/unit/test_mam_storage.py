@@ -0,0 +1,206 @@
+'''
+Tests for storing archived messages in the logs database
+'''
+# pylint: disable=protected-access
+import sqlite3
+import unittest
+from unittest.mock import MagicMock, Mock, patch
+
+import nbxmpp
+
+from gajim.common import app
+from gajim.common.const import KindConstant
+from gajim.common.helpers import AdditionalDataDict
+from gajim.common.logger import Logger
+from gajim.common.logger import LOGS_SQL_STATEMENT
+from gajim.common.modules.mam import MAM
+
+ACCOUNT = 'account'
+OWN_JID = 'me@example.org'
+CONTACT_JID = 'contact@example.org'
+ROOM_JID = 'room@conference.example.org'
+QUERY_ID = 'query1'
+
+
+def get_memory_logger():
+    # A Logger on an in-memory database instead of the files in the
+    # config dir
+    logger = Logger.__new__(Logger)
+    logger._jid_ids = {}
+    logger._jid_types = {}
+    logger._jids_not_in_db = set()
+    logger._disco_info_cache = {}
+    logger._commit_timout_id = None
+    logger._timeout_commit = Mock()
+    logger._con = sqlite3.connect(':memory:')
+    logger._con.row_factory = Logger.namedtuple_factory
+    logger._con.executescript(LOGS_SQL_STATEMENT)
+    return logger
+
+
+def get_properties(stanza_id, body, groupchat=False, mam_1=False,
+                   timestamp=1000):
+    archive_jid = ROOM_JID if groupchat else OWN_JID
+    archive = MagicMock()
+    archive.__str__.return_value = archive_jid
+    archive.bareMatch.return_value = True
+
+    properties = Mock()
+    properties.is_mam_message = True
+    properties.type.is_groupchat = groupchat
+    properties.is_self_message = False
+    properties.is_muc_pm = False
+    properties.has_user_delay = False
+    properties.is_oob = False
+    properties.is_encrypted = False
+    properties.is_correction = False
+    properties.eme = None
+    properties.body = body
+    properties.id = None
+    properties.muc_nickname = 'nick' if groupchat else None
+    properties.from_.bareMatch.return_value = False
+    properties.jid.getStripped.return_value = (
+        ROOM_JID if groupchat else CONTACT_JID)
+    properties.mam.archive = archive
+    properties.mam.id = stanza_id
+    properties.mam.query_id = QUERY_ID
+    properties.mam.is_ver_2 = not mam_1
+    properties.mam.namespace = nbxmpp.NS_MAM_1 if mam_1 else nbxmpp.NS_MAM_2
+    properties.mam.timestamp = timestamp
+    return properties
+
+
+class TestMAMStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = get_memory_logger()
+        self.nec = Mock()
+        patches = [
+            patch.object(app, 'get_jid_from_account',
+                         lambda account: OWN_JID),
+            patch.object(app, 'logger', self.logger, create=True),
+            patch.object(app, 'nec', self.nec, create=True),
+        ]
+        for patch_ in patches:
+            patch_.start()
+            self.addCleanup(patch_.stop)
+
+        con = Mock()
+        con.name = ACCOUNT
+        self.mam = MAM(con)
+
+    def tearDown(self):
+        self.logger._con.close()
+
+    def _receive_page(self, archive_jid, messages):
+        self.mam._mam_query_ids[archive_jid] = QUERY_ID
+        for properties in messages:
+            self.mam._mam_message_received(None, Mock(), properties)
+        self.mam._flush_mam_batch(QUERY_ID)
+
+    def _get_stored_stanza_ids(self):
+        sql = 'SELECT stanza_id FROM logs ORDER BY log_line_id'
+        return [row.stanza_id for row in self.logger._con.execute(sql)]
+
+    def _get_stored_events(self):
+        events = [call[0][0]
+                  for call in self.nec.push_incoming_event.call_args_list]
+        return [event for event in events
+                if event.name == 'mam-decrypted-message-received']
+
+    def test_in_page_duplicates(self):
+        self._receive_page(OWN_JID, [get_properties('a', 'first'),
+                                     get_properties('b', 'second'),
+                                     get_properties('a', 'first')])
+
+        self.assertEqual(self._get_stored_stanza_ids(), ['a', 'b'])
+        self.assertEqual(len(self._get_stored_events()), 2)
+
+    def test_mam_1_in_page_duplicates(self):
+        # mam:1 has no stanza-id, duplicates are found by text and time
+        self._receive_page(OWN_JID, [
+            get_properties('a', 'first', mam_1=True),
+            get_properties('b', 'second', mam_1=True),
+            get_properties('c', 'first', mam_1=True, timestamp=1010),
+            get_properties('d', 'first', mam_1=True, timestamp=2000)])
+
+        self.assertEqual(self._get_stored_stanza_ids(), ['a', 'b', 'd'])
+        self.assertEqual(len(self._get_stored_events()), 3)
+
+    def test_stored_duplicates(self):
+        self.logger.insert_into_logs(ACCOUNT, CONTACT_JID, 900,
+                                     KindConstant.CHAT_MSG_RECV,
+                                     message='first', stanza_id='a')
+
+        self._receive_page(OWN_JID, [get_properties('a', 'first'),
+                                     get_properties('b', 'second')])
+
+        self.assertEqual(self._get_stored_stanza_ids(), ['a', 'b'])
+        self.assertEqual(len(self._get_stored_events()), 1)
+
+    def test_groupchat_page(self):
+        # The same stanza-id in the own archive is no duplicate for a MUC
+        self._receive_page(OWN_JID, [get_properties('a', 'chat')])
+        self._receive_page(ROOM_JID, [get_properties('a', 'muc', True),
+                                      get_properties('a', 'muc', True)])
+
+        self.assertEqual(self._get_stored_stanza_ids(), ['a', 'a'])
+        row = self.logger._con.execute(
+            'SELECT kind, contact_name FROM logs WHERE message = ?',
+            ('muc',)).fetchone()
+        self.assertEqual(row.kind, KindConstant.GC_MSG)
+        self.assertEqual(row.contact_name, 'nick')
+
+    def test_find_stanza_ids(self):
+        self.logger.insert_logs_bulk(ACCOUNT, [
+            (CONTACT_JID, 1000, KindConstant.CHAT_MSG_RECV, 'chat',
+             None, None, 'chat-id', None),
+            (ROOM_JID, 1000, KindConstant.GC_MSG, 'muc',
+             'nick', None, 'muc-id', None),
+        ])
+        ids = ['chat-id', 'muc-id', 'unknown-id']
+
+        self.assertEqual(
+            self.logger.find_stanza_ids(ACCOUNT, OWN_JID, ids),
+            {'chat-id'})
+        self.assertEqual(
+            self.logger.find_stanza_ids(ACCOUNT, ROOM_JID, ids,
+                                        groupchat=True),
+            {'muc-id'})
+        self.assertEqual(
+            self.logger.find_stanza_ids(
+                ACCOUNT, 'other@conference.example.org', ids,
+                groupchat=True),
+            set())
+        self.assertEqual(
+            self.logger.find_stanza_ids(ACCOUNT, OWN_JID, []), set())
+
+    def test_bulk_insert_matches_single_insert(self):
+        additional_data = AdditionalDataDict()
+        additional_data.set_value('gajim', 'oob_url', 'https://example.org')
+        self.logger.insert_into_logs(ACCOUNT, CONTACT_JID, 1000,
+                                     KindConstant.CHAT_MSG_RECV,
+                                     unread=False,
+                                     message='text',
+                                     contact_name=None,
+                                     additional_data=additional_data,
+                                     stanza_id='a',
+                                     message_id='m')
+        self.logger.insert_logs_bulk(ACCOUNT, [
+            (CONTACT_JID, 1000, KindConstant.CHAT_MSG_RECV, 'text',
+             None, additional_data, 'a', 'm'),
+            (CONTACT_JID, 1000, KindConstant.CHAT_MSG_RECV, 'text',
+             None, AdditionalDataDict(), 'b', 'n'),
+        ])
+
+        sql = '''SELECT account_id, jid_id, time, kind, message,
+                 contact_name, additional_data, stanza_id, message_id
+                 FROM logs ORDER BY log_line_id'''
+        single, bulk, empty = [tuple(row) for row in
+                               self.logger._con.execute(sql)]
+        self.assertEqual(single, bulk)
+        self.assertIsNone(empty[6])
+
+
+if __name__ == '__main__':
+    unittest.main()